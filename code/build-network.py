@@ -1,10 +1,21 @@
+import argparse
 import csv
+import hashlib
+import json
 import re
+import multiprocessing
 import os
+import pickle
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from collections import defaultdict
+from functools import lru_cache
 
 import networkx as nx
+import numpy as np
+import pandas as pd
 import requests
 
 # Include cell types in the graph?
@@ -20,15 +31,108 @@ VERSION = "v2.2"
 
 OUTPUT_DIR= './data/' + VERSION
 
-if os.path.isdir(OUTPUT_DIR):
-    pass
-else:
-    os.mkdir(OUTPUT_DIR)
-
-ASCTB_DATA = "https://cdn.humanatlas.io/hra-asctb-json-releases/hra-asctb-all." + VERSION + ".json" # Modify to updated release version
-data = requests.get(ASCTB_DATA).json()
-
-
+ASCTB_RELEASES = "https://cdn.humanatlas.io/hra-asctb-json-releases/hra-asctb-all."
+
+ASCTB_DATA = ASCTB_RELEASES + VERSION + ".json" # Modify to updated release version
+
+# Downloaded releases are kept here and only fetched again when the server reports a change
+CACHE_DIR = "./data/.cache"
+
+
+def load_cache_index(cache_dir):
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_cache_index(cache_dir, index):
+    index_path = os.path.join(cache_dir, "index.json")
+    with open(index_path + ".tmp", "w", encoding="utf8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def fetch_release(url, cache_dir=CACHE_DIR, offline=False):
+    """
+    Return the path of a local copy of the release JSON at `url`.
+
+    Releases are stored by the SHA-256 of their content, with an index from URL to hash and to the
+    ETag/Last-Modified validators of the last download. A cached release is revalidated with a
+    conditional request, so an unchanged release is never downloaded twice. With `offline` the
+    network is not used at all and a release missing from the cache is an error. When the server
+    cannot be reached or fails (5xx), the cached copy is used if there is one.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    index = load_cache_index(cache_dir)
+    entry = index.get(url)
+    cached = os.path.join(cache_dir, entry["sha256"] + ".json") if entry else None
+    if cached and not os.path.exists(cached):
+        entry, cached = None, None
+
+    if offline:
+        if cached is None:
+            raise FileNotFoundError(f"{url} is not in the cache at {cache_dir}, run once without --offline")
+        return cached
+
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, stream=True, timeout=60)
+        if response.status_code >= 500:
+            response.close()
+            response.raise_for_status()
+    except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as error:
+        if cached is None:
+            raise
+        print(f"could not get {url} ({error}), using the cached copy")
+        return cached
+
+    with response:
+        if response.status_code == 304 and cached:
+            print("release not modified:", cached)
+            return cached
+        response.raise_for_status()
+
+        sha256 = hashlib.sha256()
+        fd, part_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    sha256.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            # a failed or interrupted download leaves nothing behind in the cache
+            os.remove(part_path)
+            raise
+
+    digest = sha256.hexdigest()
+    path = os.path.join(cache_dir, digest + ".json")
+    os.replace(part_path, path)
+
+    # drop the previous copy of this release unless another URL still points to it
+    if entry and entry["sha256"] != digest and not any(
+        other["sha256"] == entry["sha256"] for key, other in index.items() if key != url
+    ):
+        os.remove(cached)
+
+    index[url] = {
+        "sha256": digest,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    save_cache_index(cache_dir, index)
+    print("release downloaded:", path)
+    return path
+
+
+# the same names come back in every table and every release of a batch build
+@lru_cache(maxsize=None)
 def get_temp_code(str):
     str = str.strip()
     str = str.lower()
@@ -84,17 +188,38 @@ SYSTEMS = [
 ]
 SECONDARY_NETWORK = set(["blood_vasculature"])
 
+# Slow graph exports that can be selected per run with --exports, and the file each one writes
+EXPORTS = ["graphml", "dot", "svg", "blood-svg"]
+EXPORT_FILES = {
+    "graphml": "asct-tree.graphml",
+    "dot": "asct-tree.dot",
+    "svg": "asct-tree.svg",
+    "blood-svg": "asct-blood-vasculature.svg",
+}
+
+# Low-cardinality columns that are stored as categoricals in the Parquet outputs
+CATEGORICAL_COLUMNS = ["type", "organ", "source_type", "target_type"]
+
 skip_organs = set(["bonemarrow-pelvis"] + SYSTEMS)
-tables = list(sorted(filter(lambda x: x not in skip_organs, data.keys())))
-if INCLUDE_SYSTEMS:
-    tables = SYSTEMS + tables
-else:
-    tables = ["blood-vasculature"] + tables
-
-paths = []
-for table in tables:
-    rows = data[table]
+
+
+def is_included(table):
+    if INCLUDE_SYSTEMS:
+        return table not in skip_organs or table in SYSTEMS
+    return table not in skip_organs or table == "blood-vasculature"
+
+
+def get_tables(keys):
+    tables = list(sorted(filter(lambda x: x not in skip_organs, keys)))
+    if INCLUDE_SYSTEMS:
+        return SYSTEMS + tables
+    else:
+        return ["blood-vasculature"] + tables
+
+
+def get_table_paths(table, rows):
     organ = table.replace("-", "_")
+    paths = []
     for row in rows["data"]:
         as_path = [get_item(item, organ, "AS") for item in row["anatomical_structures"]]
         ct_path = [get_item(item, organ, "CT") for item in row["cell_types"]]
@@ -102,9 +227,88 @@ for table in tables:
         if organ == "blood_vasculature":
             as_path[0] = BLOOD_VASCULATURE
         paths.append({"organ": organ, "as": as_path, "ct": ct_path})
-
-
-tree = nx.DiGraph()
+    return paths
+
+
+def iter_release_tables(path, stream=False):
+    """
+    Yield the (table, rows) pairs of the release JSON at `path`.
+
+    With `stream` the file is parsed incrementally and only one organ table is held in memory at a
+    time, instead of the whole multi-organ release.
+    """
+    if not stream:
+        with open(path, encoding="utf8") as f:
+            yield from json.load(f).items()
+        return
+
+    try:
+        import ijson
+    except ImportError:
+        raise ImportError("--stream needs the ijson package: pip install ijson")
+
+    with open(path, "rb") as f:
+        yield from ijson.kvitems(f, "", use_float=True)
+
+
+def get_table_hash(table, rows):
+    """Hash of everything the paths of a table depend on: its name, its rows and FACET_BY_TABLE."""
+    content = json.dumps([table, FACET_BY_TABLE, rows], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def get_paths(release_path, stream=False, workers=1, path_cache=None):
+    """
+    Return the paths of all included tables of the release, in the order of `get_tables`, and the
+    content hash of each included table (only computed with `path_cache`).
+
+    Organ tables are independent of each other, so with `workers` > 1 they are converted to paths
+    on a process pool. The results are merged in table order, the same as a serial run. With
+    `path_cache` the paths of every table are pickled in that directory under the table's hash, and
+    a table that is already there is loaded instead of converted again.
+    """
+    table_paths = {}
+    table_hashes = {}
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for table, rows in iter_release_tables(release_path, stream):
+            if is_included(table):
+                cached = None
+                if path_cache:
+                    table_hashes[table] = get_table_hash(table, rows)
+                    cached = os.path.join(path_cache, table_hashes[table] + ".pickle")
+
+                if cached and os.path.exists(cached):
+                    with open(cached, "rb") as f:
+                        table_paths[table] = pickle.load(f)
+                elif pool:
+                    table_paths[table] = pool.submit(get_table_paths, table, rows)
+                else:
+                    table_paths[table] = get_table_paths(table, rows)
+            del rows
+
+        for table in table_paths:
+            if pool and not isinstance(table_paths[table], list):
+                table_paths[table] = table_paths[table].result()
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # store the new tables before build_tree renames any of their items
+    if path_cache:
+        os.makedirs(path_cache, exist_ok=True)
+        for table, digest in table_hashes.items():
+            cached = os.path.join(path_cache, digest + ".pickle")
+            if not os.path.exists(cached):
+                fd, part_path = tempfile.mkstemp(dir=path_cache, suffix=".part")
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(table_paths[table], f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(part_path, cached)
+
+    paths = []
+    for table in get_tables(table_paths.keys()):
+        paths.extend(table_paths.pop(table))
+    return paths, table_hashes
 
 
 def add_node(tree, item):
@@ -131,110 +335,437 @@ def add_edge(tree, source, target):
     )
 
 
-add_node(tree, BODY)
-dup = 0
-for path in paths:
-    if INCLUDE_CELL_TYPES:
-        as_path = path["as"] + path["ct"]
-    else:
-        as_path = path["as"]
-    if not tree.has_node(as_path[0].id):
-        add_node(tree, as_path[0])
-        add_edge(tree, BODY, as_path[0])
-
-    for src in range(len(as_path) - 1):
-        source, target = as_path[src], as_path[src + 1]
-        if source.id != target.id and not tree.has_edge(source.id, target.id):
-            if not tree.has_node(source.id):
-                add_node(tree, source)
-            else:  # source node exists
-                found_child = None
-                for child in tree.successors(source.id):
-                    if tree.nodes[child]["ontology_id"] == target.ontology_id:
-                        target.id = child
-                        found_child = True
-
-                # target node is in the graph, but not connected to this source node
-                if not found_child and tree.has_node(target.id):
-                    dup += 1
-                    target.id = f"{target.id}$${dup}"
-
-            if not tree.has_node(target.id):
-                add_node(tree, target)
-
-            add_edge(tree, source, target)
-
-print("is tree?", nx.is_tree(tree))
-print("has cycles?", nx.algorithms.dag.has_cycle(tree))
-print("duplicated nodes:", dup)
-print("nodes:", nx.number_of_nodes(tree))
-print("edges:", nx.number_of_edges(tree))
-nx.write_graphml_lxml(tree, OUTPUT_DIR + "/asct-tree.graphml")
-nx.nx_agraph.write_dot(tree, OUTPUT_DIR + "/asct-tree.dot")
-nx.nx_agraph.to_agraph(tree).draw(OUTPUT_DIR + "/asct-tree.svg", prog="dot")
-
-with open(OUTPUT_DIR + "/asct-nodes.csv", "w", newline="") as csvfile:
-    header = ["id", "name", "type", "organ", "ontology_id"]
-    writer = csv.writer(csvfile)
-
-    writer.writerow(header)
-    for id, data in tree.nodes.items():
-        writer.writerow([data[col] for col in header])
-
-with open(OUTPUT_DIR + "/asct-edges.csv", "w", newline="") as csvfile:
-    header = ["organ", "source", "target", "source_type", "target_type"]
-    writer = csv.writer(csvfile)
-
-    writer.writerow(header)
-    for id, data in tree.edges.items():
-        writer.writerow([data[col] for col in header])
+def add_child_edge(tree, child_index, source, target):
+    add_edge(tree, source, target)
+    child_index[(source.id, tree.nodes[target.id]["ontology_id"])] = target.id
 
 
-node_lookup = defaultdict(list)
-for id, data in tree.nodes.items():
-    node_lookup[data["ontology_id"]].append(data)
+def build_tree(paths):
+    """
+    Merge the paths into one tree under the body node and return it with the number of duplicated
+    nodes. A node reached from a second parent is duplicated as `<id>$$<n>`.
+    """
+    tree = nx.DiGraph()
 
-orig_tree = tree
-tree = nx.DiGraph()
+    # (parent id, ontology_id) -> id of the last child added with that ontology_id, so finding an
+    # existing child does not need a scan over all successors of the parent
+    child_index = {}
 
-for path in paths:
-    if path["organ"] in SECONDARY_NETWORK:
+    add_node(tree, BODY)
+    dup = 0
+    for path in paths:
         if INCLUDE_CELL_TYPES:
             as_path = path["as"] + path["ct"]
         else:
             as_path = path["as"]
+        if not tree.has_node(as_path[0].id):
+            add_node(tree, as_path[0])
+            add_child_edge(tree, child_index, BODY, as_path[0])
 
         for src in range(len(as_path) - 1):
-            orig_source, orig_target = as_path[src], as_path[src + 1]
-
-            for source in node_lookup[orig_source.ontology_id]:
-                for target in node_lookup[orig_target.ontology_id]:
-                    if orig_target.type == "CT":
-                        add_edge = orig_tree.has_edge(source["id"], target["id"])
-                    elif orig_target.type == "AS":
-                        add_edge = True
-
-                    if add_edge and not tree.has_edge(source["id"], target["id"]):
-                        tree.add_edge(
-                            source["id"],
-                            target["id"],
-                            organ=target["organ"],
-                            source=source["id"],
-                            target=target["id"],
-                            source_type=source["type"],
-                            target_type=target["type"],
-                        )
-
-print("secondary network is tree?", nx.is_tree(tree))
-print("secondary network has cycles?", nx.algorithms.dag.has_cycle(tree))
-print("secondary nodes:", nx.number_of_nodes(tree))
-print("secondary edges:", nx.number_of_edges(tree))
-nx.nx_agraph.to_agraph(tree).draw(OUTPUT_DIR + "/asct-blood-vasculature.svg", prog="dot")
-
-with open(OUTPUT_DIR + "/asct-blood-vasculature-edges.csv", "w", newline="") as csvfile:
+            source, target = as_path[src], as_path[src + 1]
+            if source.id != target.id and not tree.has_edge(source.id, target.id):
+                if not tree.has_node(source.id):
+                    add_node(tree, source)
+                else:  # source node exists
+                    found_child = child_index.get((source.id, target.ontology_id))
+                    if found_child is not None:
+                        target.id = found_child
+
+                    # target node is in the graph, but not connected to this source node
+                    if not found_child and tree.has_node(target.id):
+                        dup += 1
+                        target.id = f"{target.id}$${dup}"
+
+                if not tree.has_node(target.id):
+                    add_node(tree, target)
+
+                add_child_edge(tree, child_index, source, target)
+
+    return tree, dup
+
+
+def build_secondary_network(tree, paths):
+    """
+    Return the blood vasculature network and its edge table.
+
+    The network connects every node that shares an ontology_id with the source of a blood
+    vasculature path step to every node that shares one with its target. It is built as a join of
+    a table of path steps with the node table instead of a nested loop per step.
+    """
+    steps = []
+    for path in paths:
+        if path["organ"] in SECONDARY_NETWORK:
+            if INCLUDE_CELL_TYPES:
+                as_path = path["as"] + path["ct"]
+            else:
+                as_path = path["as"]
+
+            for orig_source, orig_target in zip(as_path, as_path[1:]):
+                steps.append((orig_source.ontology_id, orig_target.ontology_id, orig_target.type))
+
+    # only the first occurrence of a step decides the order of the edges, repeats add nothing
+    steps = pd.DataFrame(steps, columns=["source_ontology_id", "target_ontology_id", "step_type"]).drop_duplicates()
+    steps["step"] = range(len(steps))
+
+    node_table = pd.DataFrame(
+        [(data["id"], data["type"], data["organ"], data["ontology_id"]) for data in tree.nodes.values()],
+        columns=["id", "type", "organ", "ontology_id"],
+    )
+    node_table["rank"] = range(len(node_table))
+
+    pairs = steps.merge(node_table.add_prefix("source_"), on="source_ontology_id").merge(
+        node_table.add_prefix("target_"), on="target_ontology_id"
+    )
+
+    # cell types are only linked where the partonomy has that exact edge
+    is_tree_edge = pd.MultiIndex.from_frame(pairs[["source_id", "target_id"]]).isin(list(tree.edges))
+    pairs = pairs[(pairs["step_type"] == "AS") | ((pairs["step_type"] == "CT") & is_tree_edge)]
+
+    # keep the edge order of the nested loop: by step, then by node order of the source and the target
+    pairs = pairs.sort_values(["step", "source_rank", "target_rank"], kind="stable").drop_duplicates(
+        ["source_id", "target_id"]
+    )
+
+    network = nx.DiGraph()
+    network.add_edges_from(pairs[["source_id", "target_id"]].itertuples(index=False, name=None))
+
+    # network.edges lists the edges grouped by source node, in the order the nodes entered the graph
+    node_order = pd.Series(range(network.number_of_nodes()), index=list(network.nodes))
+    edges = pairs.iloc[np.argsort(pairs["source_id"].map(node_order).to_numpy(), kind="stable")]
+    edges = edges.rename(columns={"target_organ": "organ", "source_id": "source", "target_id": "target"})
+
+    return network, edges[["organ", "source", "target", "source_type", "target_type"]]
+
+
+def write_parquet(rows, columns, path):
+    """
+    Write `rows` as a typed Parquet table next to its CSV. The organ and type columns are stored as
+    categoricals and all string columns, IDs included, are dictionary encoded.
+    """
+    frame = pd.DataFrame(rows, columns=columns)
+    for col in CATEGORICAL_COLUMNS:
+        if col in frame:
+            frame[col] = frame[col].astype("category")
+    frame.to_parquet(path, index=False, use_dictionary=True)
+
+
+def write_tables(stem, rows, columns, parquet=False):
+    with open(stem + ".csv", "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+    # hra_butterfly.py prefers the Parquet copy, so never leave one behind that is older than the CSV
+    if parquet:
+        write_parquet(rows, columns, stem + ".parquet")
+    elif os.path.exists(stem + ".parquet"):
+        os.remove(stem + ".parquet")
+
+
+def export_graph(graph, exports, stem):
+    if "graphml" in exports:
+        nx.write_graphml_lxml(graph, stem + ".graphml")
+    if "dot" in exports:
+        nx.nx_agraph.write_dot(graph, stem + ".dot")
+    if "svg" in exports:
+        nx.nx_agraph.to_agraph(graph).draw(stem + ".svg", prog="dot")
+
+
+def start_export(graph, exports, stem, max_render_nodes):
+    """
+    Write the selected `exports` of `graph` to `stem`.<format> in a separate process, so the CSV
+    outputs do not wait for the graphviz layouts. The dot layout of a graph with more than
+    `max_render_nodes` nodes is skipped.
+
+    Returns the process (None if there is nothing to export) and the exports it runs.
+    """
+    if "svg" in exports and graph.number_of_nodes() > max_render_nodes:
+        print(f"not rendering {stem}.svg: {graph.number_of_nodes()} nodes is more than {max_render_nodes}")
+        exports = [export for export in exports if export != "svg"]
+    if not exports:
+        return None, []
+
+    process = multiprocessing.Process(target=export_graph, args=(graph, exports, stem))
+    process.start()
+    return process, exports
+
+
+def wait_for_exports(processes, timeout):
+    """
+    Wait at most `timeout` seconds in total for the export processes and stop the ones still running.
+    Returns the names of the exports that failed or were stopped.
+    """
+    deadline = time.monotonic() + timeout
+    failed = []
+    for name, process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            print(f"export of {name} stopped after the {timeout}s timeout")
+            failed.append(name)
+        elif process.exitcode != 0:
+            print(f"export of {name} failed with exit code {process.exitcode}")
+            failed.append(name)
+    return failed
+
+
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, "build-manifest.json")
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir, manifest):
+    with open(os.path.join(output_dir, "build-manifest.json"), "w", encoding="utf8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_keys(path, columns):
+    """The set of `columns` values of a previously written CSV, empty if there is none."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline="", encoding="utf8") as csvfile:
+        if len(columns) == 1:
+            return {row[columns[0]] for row in csv.DictReader(csvfile)}
+        return {tuple(row[col] for col in columns) for row in csv.DictReader(csvfile)}
+
+
+def diff_keys(old, new):
+    return {"added": sorted(new - old), "removed": sorted(old - new)}
+
+
+def get_change_report(manifest, table_hashes, previous, current):
+    """
+    Compare a build with the one recorded in `manifest`: which tables were added, removed or
+    changed, and which nodes, edges and blood vasculature edges appeared or disappeared.
+    """
+    old_hashes = manifest.get("tables", {})
+    report = {
+        "tables": {
+            "added": sorted(set(table_hashes) - set(old_hashes)),
+            "removed": sorted(set(old_hashes) - set(table_hashes)),
+            "changed": sorted(t for t in table_hashes if t in old_hashes and old_hashes[t] != table_hashes[t]),
+            "unchanged": sorted(t for t in table_hashes if old_hashes.get(t) == table_hashes[t]),
+        }
+    }
+    for name in current:
+        report[name] = diff_keys(previous[name], current[name])
+    return report
+
+
+def get_output_dir(version):
+    """The output folder of a release: OUTPUT_DIR for VERSION, a folder named after the version next to it otherwise."""
+    if version == VERSION:
+        return OUTPUT_DIR
+    return os.path.join(os.path.dirname(OUTPUT_DIR), version)
+
+
+def build(version, release_path, args, output_dir=OUTPUT_DIR):
+    """
+    Build the network of one release into `output_dir` and return a summary of the build.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.monotonic()
+
+    # everything the outputs depend on besides the tables themselves
+    manifest = {
+        "release": os.path.splitext(os.path.basename(release_path))[0],
+        "options": {
+            "INCLUDE_CELL_TYPES": INCLUDE_CELL_TYPES,
+            "INCLUDE_SYSTEMS": INCLUDE_SYSTEMS,
+            "FACET_BY_TABLE": FACET_BY_TABLE,
+            "parquet": args.parquet,
+            "max_render_nodes": args.max_render_nodes,
+        },
+    }
+    outputs = {
+        "nodes": (output_dir + "/asct-nodes.csv", ["id"]),
+        "edges": (output_dir + "/asct-edges.csv", ["source", "target"]),
+        "blood_edges": (output_dir + "/asct-blood-vasculature-edges.csv", ["source", "target"]),
+    }
+
+    previous_manifest = load_manifest(output_dir)
+    if args.incremental:
+        # an export counts as done if it completed last time and its file is still there, or if it was
+        # skipped because of the size of the graph, which is the same for the same release and options
+        previous_exports = previous_manifest.get("exports", {})
+        if (
+            previous_manifest.get("release") == manifest["release"]
+            and previous_manifest.get("options") == manifest["options"]
+            and all(os.path.exists(path) for path, columns in outputs.values())
+            and all(
+                previous_exports.get(export) == "skipped"
+                or (previous_exports.get(export) == "done" and os.path.exists(os.path.join(output_dir, EXPORT_FILES[export])))
+                for export in args.exports
+            )
+        ):
+            print(version, "release, options and exports unchanged since the last build, nothing to do")
+            return {"version": version, "release": manifest["release"], "skipped": True}
+        previous = {name: read_keys(path, columns) for name, (path, columns) in outputs.items()}
+
+    path_cache = os.path.join(args.cache_dir, "paths") if args.incremental else None
+    paths, table_hashes = get_paths(release_path, args.stream, args.workers, path_cache)
+    tree, dup = build_tree(paths)
+
+    print("is tree?", nx.is_tree(tree))
+    print("has cycles?", nx.algorithms.dag.has_cycle(tree))
+    print("duplicated nodes:", dup)
+    print("nodes:", nx.number_of_nodes(tree))
+    print("edges:", nx.number_of_edges(tree))
+
+    header = ["id", "name", "type", "organ", "ontology_id"]
+    rows = [[data[col] for col in header] for id, data in tree.nodes.items()]
+    write_tables(output_dir + "/asct-nodes", rows, header, args.parquet)
+
     header = ["organ", "source", "target", "source_type", "target_type"]
-    writer = csv.writer(csvfile)
+    rows = [[data[col] for col in header] for id, data in tree.edges.items()]
+    write_tables(output_dir + "/asct-edges", rows, header, args.parquet)
+
+    # (name, process, the selected exports it runs)
+    exports = []
+    tree_exports = [export for export in args.exports if export != "blood-svg"]
+    process, started = start_export(tree, tree_exports, output_dir + "/asct-tree", args.max_render_nodes)
+    exports.append(("asct-tree", process, started))
+
+    network, blood_edges = build_secondary_network(tree, paths)
+
+    print("secondary network is tree?", nx.is_tree(network))
+    print("secondary network has cycles?", nx.algorithms.dag.has_cycle(network))
+    print("secondary nodes:", nx.number_of_nodes(network))
+    print("secondary edges:", nx.number_of_edges(network))
+
+    rows = list(blood_edges.itertuples(index=False, name=None))
+    write_tables(output_dir + "/asct-blood-vasculature-edges", rows, list(blood_edges.columns), args.parquet)
+
+    blood_exports = ["svg"] if "blood-svg" in args.exports else []
+    stem = output_dir + "/asct-blood-vasculature"
+    process, started = start_export(network, blood_exports, stem, args.max_render_nodes)
+    exports.append(("asct-blood-vasculature", process, ["blood-svg"] if started else []))
+
+    if args.incremental:
+        current = {
+            "nodes": set(tree.nodes),
+            "edges": set(tree.edges),
+            "blood_edges": set(zip(blood_edges["source"], blood_edges["target"])),
+        }
+        report = get_change_report(previous_manifest, table_hashes, previous, current)
+        with open(output_dir + "/asct-changes.json", "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+
+        print("tables added/removed/changed:", *(len(report["tables"][key]) for key in ["added", "removed", "changed"]))
+        for name in current:
+            print(f"{name} added/removed:", len(report[name]["added"]), len(report[name]["removed"]))
+        manifest["tables"] = table_hashes
+
+    failed_exports = wait_for_exports([(name, process) for name, process, started in exports if process], args.export_timeout)
+
+    # written only once the exports are over, so a rerun knows which of them are still to do
+    manifest["exports"] = dict.fromkeys(args.exports, "skipped")
+    for name, process, started in exports:
+        manifest["exports"].update(dict.fromkeys(started, "failed" if name in failed_exports else "done"))
+    save_manifest(output_dir, manifest)
+
+    return {
+        "version": version,
+        "release": manifest["release"],
+        "skipped": False,
+        "nodes": tree.number_of_nodes(),
+        "edges": tree.number_of_edges(),
+        "duplicated_nodes": dup,
+        "secondary_nodes": network.number_of_nodes(),
+        "secondary_edges": network.number_of_edges(),
+        "seconds": round(time.monotonic() - start_time, 1),
+        "failed_exports": failed_exports,
+    }
+
+
+def check_exports(summary):
+    """Exit with an error if a selected export of any build did not complete."""
+    failed = [f"{s['version']}/{name}" for s in summary for name in s.get("failed_exports", [])]
+    if failed:
+        sys.exit("exports did not complete: " + ", ".join(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the ASCT+B partonomy network used by the butterfly visualization.")
+    parser.add_argument("--url", help="ASCT+B release JSON to build from (default: the release of --version)")
+    parser.add_argument("--version", default=VERSION, help="release to build, also names the build (default: %(default)s)")
+    parser.add_argument(
+        "--output-dir",
+        help="folder of the outputs of a single build (default: OUTPUT_DIR, or data/<version>), "
+        "or with --versions the folder of the per-version folders and the build summary",
+    )
+    parser.add_argument(
+        "--versions",
+        nargs="+",
+        help="build these published releases (e.g. v2.1 v2.2) in one run, each into data/<version>, "
+        "and write data/build-summary.json",
+    )
+    parser.add_argument("--version-workers", type=int, default=1, help="build that many releases at the same time")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="directory of the local release cache")
+    parser.add_argument("--offline", action="store_true", help="never touch the network, only use the local cache")
+    parser.add_argument("--stream", action="store_true", help="parse the release one organ table at a time (needs ijson)")
+    parser.add_argument("--workers", type=int, default=1, help="convert the organ tables to paths on this many processes")
+    parser.add_argument("--parquet", action="store_true", help="also write the tables as typed Parquet files (needs pyarrow)")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="skip the build if the release, options and exports are unchanged since the last one; otherwise "
+        "reuse the paths of unchanged tables (the tree, the CSVs and the exports are still rebuilt in full) "
+        "and write a change report",
+    )
+    parser.add_argument(
+        "--exports", nargs="*", choices=EXPORTS, default=EXPORTS, help="slow graph exports to write (default: all)"
+    )
+    parser.add_argument("--export-timeout", type=float, default=900, help="seconds to wait for the graph exports")
+    parser.add_argument(
+        "--max-render-nodes", type=int, default=50000, help="skip the dot layout of graphs with more nodes"
+    )
+    args = parser.parse_args()
+    if args.versions and args.url:
+        parser.error("--url builds a single release, it cannot be combined with --versions")
+
+    if not args.versions:
+        url = args.url or (ASCTB_DATA if args.version == VERSION else ASCTB_RELEASES + args.version + ".json")
+        output_dir = args.output_dir or get_output_dir(args.version)
+        summary = [build(args.version, fetch_release(url, args.cache_dir, args.offline), args, output_dir)]
+        check_exports(summary)
+        return
+
+    # download in this process only, the cache index is not safe for concurrent writers
+    releases = {
+        version: fetch_release(ASCTB_RELEASES + version + ".json", args.cache_dir, args.offline)
+        for version in args.versions
+    }
+    if args.output_dir:
+        output_dirs = {version: os.path.join(args.output_dir, version) for version in releases}
+        summary_dir = args.output_dir
+    else:
+        output_dirs = {version: get_output_dir(version) for version in releases}
+        summary_dir = os.path.dirname(OUTPUT_DIR)
+
+    if args.version_workers > 1:
+        with ProcessPoolExecutor(args.version_workers) as pool:
+            futures = [
+                pool.submit(build, version, release_path, args, output_dirs[version])
+                for version, release_path in releases.items()
+            ]
+            summary = [future.result() for future in futures]
+    else:
+        summary = [build(version, release_path, args, output_dirs[version]) for version, release_path in releases.items()]
+
+    os.makedirs(summary_dir, exist_ok=True)
+    with open(os.path.join(summary_dir, "build-summary.json"), "w", encoding="utf8") as f:
+        json.dump(summary, f, indent=2)
+    for version_summary in summary:
+        print(version_summary)
+    check_exports(summary)
+
 
-    writer.writerow(header)
-    for id, data in tree.edges.items():
-        writer.writerow([data[col] for col in header])
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import datashader
+from datashader.bundling import hammer_bundle
+
+
+class BundleCache:
+    '''
+    A disk cache of `hammer_bundle` results, so the bundling only runs for node positions, edges and
+    parameters it has not seen before.
+
+    An entry is keyed by the hash of the node frame, the edge frame, the bundling parameters and the
+    datashader version, and stored as a compressed .npz file with the 'x' and 'y' columns of the result.
+    When the files take more than `max_bytes`, the least recently used ones are deleted.
+
+    Attributes:
+    cache_dir: str
+        Directory of the cache files.
+    max_bytes: int
+        The largest total size of the cache files.
+    hits, misses, evictions: int
+        Counts since the cache was created.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=256 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, nodes, edges, params):
+        h = hashlib.sha256()
+        for frame in [nodes, edges]:
+            h.update(json.dumps([list(map(str, frame.columns)), list(map(str, frame.dtypes))]).encode())
+            h.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+        h.update(json.dumps(dict(params, datashader=datashader.__version__), sort_keys=True).encode())
+        return h.hexdigest()
+
+    def bundle(self, nodes, edges, **params):
+        '''`hammer_bundle(nodes, edges, **params)`, read from the cache if it was computed before.'''
+        path = os.path.join(self.cache_dir, f'{self.get_key(nodes, edges, params)}.npz')
+        try:
+            os.utime(path)
+            with np.load(path) as cached:
+                result = pd.DataFrame({'x': cached['x'], 'y': cached['y']})
+            self.hits += 1
+            return result
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        result = hammer_bundle(nodes, edges, **params)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, x=result['x'].to_numpy(), y=result['y'].to_numpy())
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+        return result
+
+    def evict(self, keep=None):
+        '''Delete the least recently used files until the cache fits into `max_bytes`, but never `keep`.'''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # evicted by another process sharing the directory
+                pass
+            total -= size
+            self.evictions += 1
+
+    def report(self):
+        return f'bundle cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions'
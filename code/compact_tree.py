@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+
+
+class CompactTree:
+    '''
+    A rooted tree stored in flat integer arrays, built once from an edge table.
+
+    Nodes are numbered 0..n-1 in order of first appearance in the edge table, `ids` maps these numbers back
+    to the original labels. The edges are read as undirected and oriented away from `root` by a breadth-first
+    search that visits neighbors in edge table order, the same as networkx does on a graph built with
+    `nx.from_pandas_edgelist`. If the edges do not form a tree, the arrays describe its BFS tree.
+
+    Attributes:
+    ids: np.ndarray
+        The label of every node.
+    parent: np.ndarray
+        The parent of every node, -1 for the root and for nodes that cannot be reached from it.
+    child_ptr, children: np.ndarray
+        CSR child lists, the children of node i are children[child_ptr[i]:child_ptr[i+1]] in edge table order.
+    depth: np.ndarray
+        Distance from the root, -1 for unreached nodes.
+    bfs_order: np.ndarray
+        The reached nodes in breadth-first order.
+    preorder: np.ndarray
+        Position of every node in the depth-first preorder of the tree, -1 for unreached nodes.
+    order: np.ndarray
+        The reached nodes in depth-first preorder (the inverse of `preorder`).
+    size: np.ndarray
+        Number of nodes in the subtree of every node.
+    '''
+
+    def __init__(self, ids, adj_ptr, adj, root, n_edges):
+        self.ids = ids
+        self.lookup = pd.Index(ids)
+        self.root = root
+        self.n_edges = n_edges
+        n = len(ids)
+
+        # level-synchronous BFS, the first node to reach a neighbor becomes its parent
+        parent = np.full(n, -1)
+        depth = np.full(n, -1)
+        depth[root] = 0
+        levels = [np.array([root])]
+        while True:
+            frontier = levels[-1]
+            starts = adj_ptr[frontier]
+            counts = adj_ptr[frontier + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            neighbors = adj[offsets]
+            parents = np.repeat(frontier, counts)
+
+            new = depth[neighbors] == -1
+            neighbors, parents = neighbors[new], parents[new]
+            _, first = np.unique(neighbors, return_index=True)
+            first.sort()
+            if len(first) == 0:
+                break
+            neighbors, parents = neighbors[first], parents[first]
+
+            parent[neighbors] = parents
+            depth[neighbors] = len(levels)
+            levels.append(neighbors)
+
+        self.parent = parent
+        self.depth = depth
+        self.bfs_order = np.concatenate(levels)
+
+        # children grouped by parent, in the order they were discovered (= edge table order)
+        discovered = self.bfs_order[1:]
+        by_parent = np.argsort(parent[discovered], kind='stable')
+        self.children = discovered[by_parent]
+        self.child_ptr = np.concatenate([[0], np.cumsum(np.bincount(parent[discovered], minlength=n))])
+
+        # subtree sizes bottom-up, one level at a time
+        size = np.ones(n, dtype=int)
+        for level in reversed(levels[1:]):
+            np.add.at(size, parent[level], size[level])
+        self.size = size
+
+        # preorder top-down: a child comes after its parent and after the subtrees of its earlier siblings
+        sibling_sizes = np.cumsum(size[self.children])
+        segment_start = np.concatenate([[0], sibling_sizes])[self.child_ptr[parent[self.children]]]
+        before = np.empty(n, dtype=int)
+        before[self.children] = sibling_sizes - size[self.children] - segment_start
+
+        preorder = np.full(n, -1)
+        preorder[root] = 0
+        for level in levels[1:]:
+            preorder[level] = preorder[parent[level]] + 1 + before[level]
+        self.preorder = preorder
+        self.order = np.empty(len(self.bfs_order), dtype=int)
+        self.order[preorder[self.bfs_order]] = self.bfs_order
+
+    @classmethod
+    def from_edges(cls, sources, targets, root):
+        '''
+        Build the tree from the `sources` and `targets` columns of an edge table, rooted at the node labelled `root`.
+        Missing labels (NaN or None) are not allowed.
+        '''
+        sources, targets = np.asarray(sources), np.asarray(targets)
+        if pd.isna(sources).any() or pd.isna(targets).any():
+            raise ValueError(f'the edge table has {pd.isna(sources).sum()} missing sources and {pd.isna(targets).sum()} missing targets')
+        n_rows = len(sources)
+        codes, ids = pd.factorize(np.concatenate([sources, targets]))
+        u, v = codes[:n_rows], codes[n_rows:]
+
+        # drop self loops and repeated edges, networkx keeps the position of the first one
+        keep = u != v
+        u, v = u[keep], v[keep]
+        key = np.minimum(u, v) * len(ids) + np.maximum(u, v)
+        _, first = np.unique(key, return_index=True)
+        first.sort()
+        u, v = u[first], v[first]
+
+        # undirected adjacency in CSR form, the neighbors of a node in edge table order
+        ends = np.concatenate([u, v])
+        neighbors = np.concatenate([v, u])
+        rows = np.concatenate([np.arange(len(u)), np.arange(len(u))])
+        by_end = np.lexsort((rows, ends))
+        adj_ptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=len(ids)))])
+
+        ids = np.asarray(ids, dtype=object)
+        return cls(ids, adj_ptr, neighbors[by_end], pd.Index(ids).get_loc(root), len(u))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, labels):
+        '''Node numbers of `labels` (-1 for unknown labels).'''
+        return self.lookup.get_indexer(np.atleast_1d(labels))
+
+    def is_tree(self):
+        return self.n_edges == len(self) - 1 and len(self.bfs_order) == len(self)
+
+    def subtree(self, label):
+        '''Node numbers of the subtree under `label` (including it) in depth-first preorder.'''
+        node = self.index(label)[0]
+        start = self.preorder[node]
+        return self.order[start:start + self.size[node]]
+
+    def subtrees(self, labels):
+        '''Node numbers of the subtrees under each of `labels`, one after the other, each in depth-first preorder.'''
+        nodes = self.index(labels)
+        starts = self.preorder[nodes]
+        counts = self.size[nodes]
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.order[offsets]
+
+    def dfs_preorder(self, label=None):
+        '''Labels of the subtree under `label` (by default the whole tree) in depth-first preorder.'''
+        if label is None:
+            return self.ids[self.order]
+        return self.ids[self.subtree(label)]
+
+    def bfs_predecessors(self):
+        '''Dictionary from the label of every reached node to the label of its parent, like `nx.bfs_predecessors`.'''
+        nodes = self.bfs_order[1:]
+        return dict(zip(self.ids[nodes], self.ids[self.parent[nodes]]))
+
+    def depths(self):
+        '''Dictionary from label to distance from the root in BFS order, like `nx.single_source_shortest_path_length`.'''
+        return dict(zip(self.ids[self.bfs_order], self.depth[self.bfs_order]))
+
+    def ancestors(self, labels):
+        '''
+        Boolean mask of the nodes that are `labels` or an ancestor of any of them.
+
+        A node is an ancestor of another if the preorder position of the other falls into the preorder range
+        of its subtree, so the closure of the whole set is one sort and one binary search per node.
+        '''
+        nodes = self.index(labels)
+        positions = np.sort(self.preorder[nodes[nodes >= 0]])
+        positions = positions[positions >= 0]
+        first = np.searchsorted(positions, self.preorder, side='left')
+        last = np.searchsorted(positions, self.preorder + self.size, side='left')
+        return (self.preorder >= 0) & (last > first)
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+def constrained_spring_layout(graph, pos, fixed, k, iterations=50, threshold=1e-4, seed=None, tolerance=None):
+    '''
+    Fruchterman-Reingold layout of a graph whose nodes are mostly pinned, iterating over the free nodes only.
+
+    The forces, the cooling and the stopping rule are those of `nx.spring_layout(graph, pos=pos, fixed=fixed,
+    k=k, iterations=iterations, threshold=threshold, seed=seed)` and the start positions of the free nodes
+    are drawn the same way, so the result is the same. A free node is pushed away from every node and pulled
+    towards its neighbours: the push is computed for the rows of the free nodes only and the pull is taken from
+    the list of the edges at a free node, so no adjacency matrix is built.
+
+    Parameters:
+    graph: nx.Graph
+        The graph to lay out.
+    pos: dict
+        The coordinates of the pinned nodes (at least).
+    fixed: list
+        The nodes that do not move, all of them need coordinates in `pos`.
+    k: float
+        The optimal distance between the nodes.
+    iterations: int
+        The largest number of iterations.
+    threshold: float
+        The iterations stop when the movement of the nodes, divided by the number of nodes, falls below it. This is
+        the rule of networkx; every free node moves by the current temperature, so it rarely fires.
+    seed: int
+        The seed of the start positions of the free nodes.
+    tolerance: float
+        If set, the iterations also stop when the largest displacement of a free node, before it is scaled to the
+        temperature, is below `tolerance` times the size of the canvas (the largest coordinate in `pos`). The
+        default None keeps the result the same as networkx's.
+
+    Returns the dictionary from node to coordinates and a dictionary with the number of iterations run, the largest
+    displacement of the last iteration relative to the size of the canvas ('displacement', to choose `tolerance`)
+    and the final energy, the sum of the attraction (d^3 / 3k) and repulsion (-k^2 ln d) potentials of the pairs
+    with a free node.
+    '''
+    nodes = list(graph)
+    n = len(nodes)
+    row = {node: i for i, node in enumerate(nodes)}
+    for node in fixed:
+        if node not in pos:
+            raise ValueError('nodes are fixed without positions given')
+
+    # start positions: random ones scaled to the domain of `pos`, overwritten by the given ones
+    dom_size = max(coord for coords in pos.values() for coord in coords) or 1
+    positions = np.random.RandomState(seed).rand(n, 2) * dom_size
+    for i, node in enumerate(nodes):
+        if node in pos:
+            positions[i] = np.asarray(pos[node])
+
+    pinned = np.zeros(n, dtype=bool)
+    pinned[[row[node] for node in fixed if node in row]] = True
+    free = np.flatnonzero(~pinned)
+    stats = {'iterations': 0, 'displacement': 0.0, 'energy': 0.0, 'free_nodes': len(free)}
+    if n < 2 or len(free) == 0:
+        return dict(zip(nodes, positions)), stats
+
+    # the edges at the free nodes, once from every free end: (row among the free nodes, other end), no pair twice
+    free_row = np.full(n, -1)
+    free_row[free] = np.arange(len(free))
+    ends = np.array([(row[u], row[v]) for u, v in graph.edges() if u != v], dtype=int).reshape(-1, 2)
+    ends = np.concatenate([ends, ends[:, ::-1]])
+    ends = ends[free_row[ends[:, 0]] >= 0]
+    source, target = free_row[ends[:, 0]], ends[:, 1]
+
+    t = max(np.ptp(positions[:, 0]), np.ptp(positions[:, 1])) * 0.1
+    dt = t / (iterations + 1)
+    for iteration in range(iterations):
+        delta = positions[free, np.newaxis, :] - positions[np.newaxis, :, :]
+        distance = np.linalg.norm(delta, axis=-1)
+        np.clip(distance, 0.01, None, out=distance)
+        # the pull only changes the entries of the edges, the sum over the pairs is the same as networkx's
+        force = k * k / distance**2
+        force[source, target] -= distance[source, target] / k
+        displacement = np.einsum('ijk,ij->ik', delta, force)
+        length = np.linalg.norm(displacement, axis=-1)
+        stats['displacement'] = float(length.max() / dom_size)
+        if tolerance is not None and stats['displacement'] < tolerance:
+            break
+        length = np.where(length < 0.01, 0.1, length)
+        delta_pos = np.einsum('ij,i->ij', displacement, t / length)
+        positions[free] += delta_pos
+        t -= dt
+        stats['iterations'] = iteration + 1
+        if (np.linalg.norm(delta_pos) / n) < threshold:
+            break
+
+    # a pair of free nodes is in the distance matrix, and an edge between them in the edge list, twice
+    distance = np.linalg.norm(positions[free, np.newaxis, :] - positions[np.newaxis, :, :], axis=-1)
+    np.clip(distance, 0.01, None, out=distance)
+    weight = np.where(pinned, 1.0, 0.5)[np.newaxis, :].repeat(len(free), axis=0)
+    weight[np.arange(len(free)), free] = 0.0
+    attraction = (weight[source, target] * distance[source, target]**3).sum() / (3 * k)
+    stats['energy'] = float(attraction - (weight * k * k * np.log(distance)).sum())
+
+    return dict(zip(nodes, positions)), stats
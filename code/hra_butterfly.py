@@ -1,461 +1,799 @@
 import pandas as pd
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import networkx as nx
 import json
+import copy
 import argparse
+import hashlib
+import pickle
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
-import vl_convert as vlc
 from datashader.bundling import hammer_bundle
 import svgutils.transform as st
 
+import bundle_cache
+import compact_tree
+import constrained_layout
+import node_index
+import radial_layout
+import svg_paths
+import vega_renderer
+from bundle_cache import BundleCache
+from compact_tree import CompactTree
+from constrained_layout import constrained_spring_layout
+from node_index import NodeIndex
+from radial_layout import get_layout_coordinates
+from svg_paths import write_svg_paths
+from vega_renderer import VegaRenderer
+
 VERSION = "v2.2"
 # Directory for butterfly outputs
 OUTPUT_DIR= './viz_' + VERSION
 
-# URLs for the data
-nodes_url = "./data/" + VERSION + "/asct-nodes.csv" 
-edges_url =  "./data/" + VERSION + "/asct-edges.csv"
-blood_edges_url =   "./data/" + VERSION + "/asct-blood-vasculature-edges.csv"
+# Directory for the cached results of the pipeline stages
+CACHE_DIR = './data/.cache/butterfly'
 
-if os.path.isdir(OUTPUT_DIR):
-    pass
-else:
-    os.mkdir(OUTPUT_DIR)
+# Directory for the cached results of the hammer bundling
+BUNDLE_CACHE_DIR = './data/.cache/bundles'
 
-# Load the data
-nodes = pd.read_csv(nodes_url)
-edges = pd.read_csv(edges_url)
+# Directory for the cached Vega renders
+VEGA_CACHE_DIR = './data/.cache/vega'
+
+# the cached results are only valid for the code that produced them
+CODE_FILES = [__file__, bundle_cache.__file__, compact_tree.__file__, constrained_layout.__file__, node_index.__file__, radial_layout.__file__,
+              svg_paths.__file__, vega_renderer.__file__]
+
+
+def read_table(url):
+    '''
+    Read one of the tables written by build-network.py. The typed Parquet copy is used when it exists,
+    otherwise the CSV is parsed with the organ and type columns as categoricals.
+    '''
+    parquet_url = os.path.splitext(url)[0] + '.parquet'
+    if os.path.exists(parquet_url):
+        return pd.read_parquet(parquet_url)
+
+    categorical_columns = ['type', 'organ', 'source_type', 'target_type']
+    return pd.read_csv(url, dtype={col: 'category' for col in categorical_columns})
+
+
+def get_file_hash(*paths):
+    '''Hash of the content of the files (a missing file hashes as empty).'''
+    h = hashlib.sha256()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+        h.update(b'\0')
+    return h.hexdigest()
 
-# Filter out the organs that are not in the butterfly
-omitted_organs = ['muscular_system', 'skeleton'] + ['lymph_vasculature', 'peripheral_nervous_system', 'blood_pelvis',] 
 
-nodes = nodes[~nodes['organ'].isin(omitted_organs)]
-edges = edges[~edges['organ'].isin(omitted_organs)]
+def get_table_hash(url):
+    '''Hash of the table `read_table` reads for `url`.'''
+    return get_file_hash(url, os.path.splitext(url)[0] + '.parquet')
 
 
+def get_output_hashes(paths):
+    '''Hash of the content of every file, None for a missing file.'''
+    return {path: get_file_hash(path) if os.path.exists(path) else None for path in paths}
+
+
+def run_stage(name, func, inputs, params, outputs=(), after=(), cache_dir=CACHE_DIR, force=False):
+    '''
+    Run one stage of the pipeline, or load its result from the cache if nothing it depends on has changed.
+
+    The key of a stage is the hash of its name, the code, its parameters and the keys of its inputs, so a change
+    anywhere upstream also changes the keys of all the stages after it. The cache entry also records the hashes of
+    the output files the stage wrote, a cached result is only used while the files are still those, not ones
+    written since by a run with other parameters.
+
+    Parameters:
+    name: str
+        The name of the stage, also the prefix of its cache file.
+    func: callable
+        Computes the result of the stage from `inputs` and `params`, passed as keyword arguments.
+    inputs: dict
+        The results of earlier stages (or input files) as (key, value) pairs. Only the keys are hashed.
+    params: dict
+        Parameters of the stage, hashed by value.
+    outputs: list
+        Files written by the stage, the stage is run again if any of them is missing or has changed.
+    after: list
+        Keys of earlier stages (or hashes of files) that the stage depends on without getting their results,
+        e.g. because it reads their output files.
+    cache_dir: str
+        Directory of the cache files.
+    force: bool
+        If True, the stage is run even if its cached result is still valid.
+
+    Returns the key and the result of the stage.
+    '''
+    key_data = {
+        'stage': name,
+        'code': get_file_hash(*CODE_FILES),
+        'params': params,
+        'inputs': {arg: key for arg, (key, value) in inputs.items()},
+        'after': list(after),
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+    cached = os.path.join(cache_dir, f'{name}-{key[:16]}.pkl')
+
+    if not force and os.path.exists(cached):
+        with open(cached, 'rb') as f:
+            entry = pickle.load(f)
+        if entry['outputs'] == get_output_hashes(outputs):
+            print(f'{name}: unchanged, using the cached result')
+            return key, entry['result']
+        print(f'{name}: output files missing or written by another run')
+
+    start = time.monotonic()
+    result = func(**{arg: value for arg, (key, value) in inputs.items()}, **params)
+    print(f'{name}: done in {time.monotonic() - start:.1f}s')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, part_path = tempfile.mkstemp(dir=cache_dir, suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump({'result': result, 'outputs': get_output_hashes(outputs)}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(part_path, cached)
+
+    return key, result
+
+
+# Filter out the organs that are not in the butterfly
+omitted_organs = ['muscular_system', 'skeleton'] + ['lymph_vasculature', 'peripheral_nervous_system', 'blood_pelvis',]
 
 # Order of organs in the butterfly
-organ_order = ['trachea', 'main bronchus', 'respiratory system', 'heart',  'spinal cord', 'brain', 'eye', 'palatine tonsil', 
-               'skin of body', 'thymus', 'lymph node', 'spleen',  'liver', 'Pancreas', 'small intestine',  'large intestine', 
-               'kidney', 'urinary bladder', 'ureter', 'prostate gland',  'ovary', 'fallopian tube', 'uterus',  
+organ_order = ['trachea', 'main bronchus', 'respiratory system', 'heart',  'spinal cord', 'brain', 'eye', 'palatine tonsil',
+               'skin of body', 'thymus', 'lymph node', 'spleen',  'liver', 'Pancreas', 'small intestine',  'large intestine',
+               'kidney', 'urinary bladder', 'ureter', 'prostate gland',  'ovary', 'fallopian tube', 'uterus',
                'placenta', 'knee', 'Bone marrow']
 
 
+def number_organ_branches(whole_tree, organ_order_in_id):
+    '''
+    Number the nodes of the organ branches one organ after the other, each branch in DFS preorder starting with
+    the organ, and the body with 0. The branches are slices of the preorder of the whole tree, so this is one pass
+    over the tree. A node in more than one branch keeps the number from the last of them.
+    '''
+    branch_nodes = whole_tree.ids[whole_tree.subtrees(organ_order_in_id)]
 
-# There are some anatomical structures that belong to the respiratory system but are connected to the 'body' node
-# Here we connect these nodes to the respiratory system node and remove the link to the body node
-new_edges = edges[(edges['source']=='UBERON:0013702')&(edges['target'].isin(['UBERON:0008886', 'UBERON:0004573', 'UBERON:0003920']))].copy()
-new_edges['source'].replace('UBERON:0013702', 'UBERON:0001004', inplace=True) #connect the nodes to respiratory system instead of body
+    id_to_graph_int_id = {whole_tree.ids[whole_tree.root]: 0}
+    id_to_graph_int_id.update(zip(branch_nodes, range(1, len(branch_nodes) + 1)))
+    return id_to_graph_int_id
 
-edges = edges[~((edges['source']=='UBERON:0013702')&(edges['target'].isin(['UBERON:0008886', 'UBERON:0004573', 'UBERON:0003920'])))]
-edges = pd.concat([edges, new_edges])
 
+def get_removable_blood_nodes(edges, blood_nodes_candidates):
+    '''
+    Get the blood vasculature nodes that can be removed from the partonomy graph. The candidates are removed one
+    at a time, the farthest from the body first, until the first one whose removal would disconnect the graph.
 
-# Create a graph
-whole_graph = nx.from_pandas_edgelist(edges, source='source', target='target', edge_attr=True)
+    On a tree, removing a node keeps the graph connected if the node is a leaf by then. All the candidates deeper
+    than a node are visited (and removed) before it, so a node is removable if all of its children are candidates,
+    and the removable nodes are the visiting order up to the first node with another child. This is a single pass
+    over the tree. On any other graph the nodes are removed one by one and the connectivity is checked each time.
 
-print(f"The graph is a tree: {nx.is_tree(whole_graph)}")
+    Parameters:
+    edges: pd.DataFrame
+        The edges of the partonomy, with the integer IDs in the 'source_int' and 'target_int' columns.
+    blood_nodes_candidates: set
+        The integer IDs of the blood vasculature nodes.
+    '''
+    tree = CompactTree.from_edges(edges['source_int'], edges['target_int'], root=0)
+
+    is_candidate = np.zeros(len(tree), dtype=bool)
+    candidates = tree.index(list(blood_nodes_candidates))
+    is_candidate[candidates[candidates >= 0]] = True
 
+    # farthest from the body first, in BFS order among the nodes at the same distance
+    node_visiting_order = tree.bfs_order[is_candidate[tree.bfs_order]]
+    node_visiting_order = node_visiting_order[np.argsort(-tree.depth[node_visiting_order], kind='stable')]
 
+    if tree.is_tree() and not is_candidate[tree.root]:
+        other_children = np.flatnonzero(~is_candidate & (tree.parent >= 0))
+        has_other_child = np.bincount(tree.parent[other_children], minlength=len(tree)) > 0
 
-# Query the nodes
-def get_nodes(name=None, ontology_id=None):
-    if name:
-        return nodes[nodes['name'].str.lower()==name.lower()]
-    if ontology_id:
-        return nodes[nodes['ontology_id']==ontology_id]   
-    
+        blocked = has_other_child[node_visiting_order]
+        stop = np.argmax(blocked) if blocked.any() else len(node_visiting_order)
+        return set(tree.ids[node_visiting_order[:stop]].tolist())
 
-organ_order_in_id = [get_nodes(name=organ)['id'].values[0] for organ in organ_order]
+    new_pruned_graph = nx.from_pandas_edgelist(edges, source='source_int', target='target_int', edge_attr=True)
 
-# Get the graph of the organ 
-def get_organ_graph(organ_id):
-    organ_graph = whole_graph.copy()
-    organ_graph.remove_edge('UBERON:0013702', organ_id) #remove the edge between body and the organ
+    removable = set()
+    for node in tree.ids[node_visiting_order]:
+        new_pruned_graph.remove_node(node)
+        if nx.is_connected(new_pruned_graph):
+            removable.add(node)
+        else:
+            break
+    return removable
 
-    connected_components = sorted(list(nx.connected_components(organ_graph)), key=len, reverse=False) #get the connected components
 
-    return nx.subgraph(organ_graph, connected_components[0]) #return the smallest connected component
+def load_partonomy(nodes_url, edges_url):
+    '''
+    Load the partonomy, number its nodes in organ order and remove the blood vasculature nodes that are not
+    necessary to keep it connected.
+
+    Parameters:
+    nodes_url: str
+        The nodes table written by build-network.py.
+    edges_url: str
+        The edges table written by build-network.py.
 
+    Returns a dictionary with the nodes and edges (with the integer IDs), the pruned nodes and edges,
+    `id_to_graph_int_id` and the remaining `blood_nodes_candidates`.
+    '''
 
+    # Load the data
+    nodes = read_table(nodes_url)
+    edges = read_table(edges_url)
 
-# Generate a new integer-based ID, that takes into account the organ order
-## (This is necesary for the layout, later we can order the nodes and edges based on this integer ID, 
-## and then vega will visualize the organs in the desired order)
+    nodes = nodes[~nodes['organ'].isin(omitted_organs)]
+    edges = edges[~edges['organ'].isin(omitted_organs)]
 
-id_to_graph_int_id = {'UBERON:0013702': 0}
 
-next_id = 1
+    # There are some anatomical structures that belong to the respiratory system but are connected to the 'body' node
+    # Here we connect these nodes to the respiratory system node and remove the link to the body node
+    new_edges = edges[(edges['source']=='UBERON:0013702')&(edges['target'].isin(['UBERON:0008886', 'UBERON:0004573', 'UBERON:0003920']))].copy()
+    new_edges['source'].replace('UBERON:0013702', 'UBERON:0001004', inplace=True) #connect the nodes to respiratory system instead of body
 
-for i, organ_id in enumerate(organ_order_in_id):
-    branch_graph = get_organ_graph(organ_id)
+    edges = edges[~((edges['source']=='UBERON:0013702')&(edges['target'].isin(['UBERON:0008886', 'UBERON:0004573', 'UBERON:0003920'])))]
+    edges = pd.concat([edges, new_edges])
 
-    branch_graph_new_ids = dict(zip(nx.dfs_preorder_nodes(branch_graph, source=organ_id), range(next_id, next_id+branch_graph.number_of_nodes())))
 
-    id_to_graph_int_id.update(branch_graph_new_ids)
+    # Create the tree (array based, it is only traversed and never modified)
+    whole_tree = CompactTree.from_edges(edges['source'], edges['target'], root='UBERON:0013702')
 
-    next_id += branch_graph.number_of_nodes()
+    print(f"The graph is a tree: {whole_tree.is_tree()}")
 
 
-nodes['graph_int_id'] = nodes['id'].map(id_to_graph_int_id)
+    node_lookup = NodeIndex(nodes)
 
-edges['source_int'] = edges['source'].map(id_to_graph_int_id)
-edges['target_int'] = edges['target'].map(id_to_graph_int_id)
+    organs = node_lookup.find(names=organ_order).drop_duplicates('key')
+    missing_organs = set(organ_order) - set(organs['key'])
+    if missing_organs:
+        raise ValueError(f'Organs not found in the nodes: {sorted(missing_organs)}')
+    organ_order_in_id = organs['id'].tolist()
 
 
-# Create the graph with the new integer IDs
-whole_graph_int = nx.from_pandas_edgelist(edges, source='source_int', target='target_int', edge_attr=True)
+    # Generate a new integer-based ID, that takes into account the organ order
+    ## (This is necesary for the layout, later we can order the nodes and edges based on this integer ID,
+    ## and then vega will visualize the organs in the desired order)
 
-graph_int_id_to_id = {v: k for k, v in id_to_graph_int_id.items()} #reverse the dictionary
+    id_to_graph_int_id = number_organ_branches(whole_tree, organ_order_in_id)
 
 
-# Removal of the blood vasculature nodes from the whole (partonomy) graph
-## We only keep those that are necessary to keep the network connected
+    node_lookup.set_graph_int_ids(id_to_graph_int_id)
 
-# remove those blood nodes from the graph, which if we remove, the graph will be still connected, repeat until no such node is found.
-blood_nodes_candidates = set(nodes[nodes['organ']=='blood_vasculature'].graph_int_id.tolist())
+    nodes['graph_int_id'] = node_lookup.get_graph_int_ids(nodes['id'])
 
-distance_from_body = nx.single_source_shortest_path_length(whole_graph_int, source=0)
+    edges['source_int'] = node_lookup.get_graph_int_ids(edges['source'])
+    edges['target_int'] = node_lookup.get_graph_int_ids(edges['target'])
 
-distance_from_body_blood_nodes = {k: v for k, v in distance_from_body.items() if k in blood_nodes_candidates}
 
-node_visiting_order = sorted(distance_from_body_blood_nodes.items(), key=lambda x: x[1], reverse=True)
+    # Removal of the blood vasculature nodes from the whole (partonomy) graph
+    ## We only keep those that are necessary to keep the network connected
 
-new_pruned_graph = whole_graph_int.copy()
+    # remove those blood nodes from the graph, which if we remove, the graph will be still connected, repeat until no such node is found.
+    blood_nodes_candidates = set(nodes[nodes['organ']=='blood_vasculature'].graph_int_id.tolist())
 
-for node in node_visiting_order:
-    new_pruned_graph.remove_node(node[0])
-    if nx.is_connected(new_pruned_graph):
-        blood_nodes_candidates.remove(node[0])
-    else:
-        break
+    blood_nodes_candidates -= get_removable_blood_nodes(edges, blood_nodes_candidates)
 
-nodes['keep'] = nodes.apply(lambda row: True if (row['organ']!='blood_vasculature' or row['graph_int_id'] in blood_nodes_candidates) else False, axis=1)
+    nodes['keep'] = (nodes['organ']!='blood_vasculature') | nodes['graph_int_id'].isin(list(blood_nodes_candidates))
 
-pruned_nodes = nodes[nodes['keep']]
-pruned_edges = edges[edges['source_int'].isin(pruned_nodes['graph_int_id']) | edges['target_int'].isin(pruned_nodes['graph_int_id'])]
-pruned_graph = nx.from_pandas_edgelist(pruned_edges, source='source_int', target='target_int', edge_attr=True)
+    pruned_nodes = nodes[nodes['keep']]
+    pruned_edges = edges[edges['source_int'].isin(pruned_nodes['graph_int_id']) | edges['target_int'].isin(pruned_nodes['graph_int_id'])]
 
+    return {
+        'nodes': nodes,
+        'edges': edges,
+        'pruned_nodes': pruned_nodes,
+        'pruned_edges': pruned_edges,
+        'id_to_graph_int_id': id_to_graph_int_id,
+        'node_lookup': node_lookup,
+        'blood_nodes_candidates': blood_nodes_candidates,
+    }
 
 
 FTUs = ['UBERON:0001285', 'UBERON:0001229', 'UBERON:0004205', 'UBERON:0001289', 'UBERON:0004193', 'UBERON:0004204', 'UBERON:0001291', 'UBERON:0004203', #kidney
         'UBERON:0001983',  'UBERON:0001984',  #large intestine
         'UBERON:0004647', #liver
-        'UBERON:0002299', 'UBERON:8410043', #lung 
+        'UBERON:0002299', 'UBERON:8410043', #lung
         'UBERON:0000006', 'UBERON:0001263', 'UBERON:0014726', #pancreas
         'UBERON:0004179', #prostate gland
         'UBERON:0000412', 'UBERON:0013487', 'UBERON:0001992', #skin
         'UBERON:0001213', #small intestine
         'UBERON:0001250', 'UBERON:0001959', #spleen
-        'UBERON:0002125' 
+        'UBERON:0002125'
         ]
 
 
 
 
-def construct_network_create_vega_viz(nodes_dataframe, edges_dataframe, filename='butterfly', only_female=False, only_male=False, scenegraph=False, show_labels=False):
+# The organs only in the male and only in the female wing
+MALE_ORGANS = ['prostate']
+FEMALE_ORGANS = ['fallopian_tube', 'ovary', 'uterus', 'placenta']
+
+
+def get_vega_node_table(nodes_dataframe, edges_dataframe):
     '''
-    Construct the network and create the vega visualization file, which is a JSON file. 
-    Vega will visualize the network based on the config file. Using the API we can create the SVG and the "scenegraph" which will be used for the coordinates of the nodes.
+    The node table shared by all the Vega configs: the nodes in the order of their integer id with the parent
+    of every node for the tree layout and its color.
 
     Parameters:
     nodes_dataframe: pd.DataFrame
         The dataframe containing the nodes of the network. It should have the following columns: 'id', 'name', 'type', 'organ', 'ontology_id', 'graph_int_id'.
     edges_dataframe: pd.DataFrame
         The dataframe containing the edges of the network. It should have the following columns: 'source_int', 'target_int', 'organ'.
-    filename: str
-        The name of the file to be saved
-    only_female: bool
-        If True, the visualization will not contain the prostate (so far that's the only male organ).
-    only_male: bool
-        If True, the visualization will not contain the ovaries, fallopian tube, uterus, placenta (so far these are the female organs).
-    scenegraph: bool
-        If True, the name of the nodes will be the id of the nodes. This is necessary to later get the coordinates of the nodes based on the IDs.
-    show_labels: bool
-        If True, the labels of the nodes will be shown (in the SVG file).
-    '''
 
-    nodes_df = nodes_dataframe.sort_values('graph_int_id').copy() 
-    edges_df = edges_dataframe.sort_values('target_int').copy() #sorting is necessary for the order of the branches in the visualization
+    Returns the table with Vega's column names: 'id' is the integer id and the ontology id is in 'id_from_ontology_id'.
+    '''
 
-    # create the graph
-    graph = nx.from_pandas_edgelist(edges_df, source='source_int', target='target_int', edge_attr=True)
+    nodes_df = nodes_dataframe.sort_values('graph_int_id').copy()
+    edges_df = edges_dataframe.sort_values('target_int') #sorting is necessary for the order of the branches in the visualization
 
     # get the parent of each node for the tree layout
-    parents_dict = dict(nx.bfs_predecessors(graph, source=0))
+    parents_dict = CompactTree.from_edges(edges_df['source_int'], edges_df['target_int'], root=0).bfs_predecessors()
 
     nodes_df['parent'] = nodes_df['graph_int_id'].map(parents_dict).fillna(0).astype(int)
 
     # set the color of the nodes based on the type
-    nodes_df['color'] = nodes_df.apply(lambda row: '#56a04e' if row['ontology_id'] in FTUs else ('#984ea0' if row['type']=='AS' else '#ff7f00'), axis=1)
-
+    nodes_df['color'] = np.select([nodes_df['ontology_id'].isin(FTUs), nodes_df['type']=='AS'], ['#56a04e', '#984ea0'], '#ff7f00')
 
     # vega works with the id column, so we rename the id column to id_from_ontology_id
     nodes_df.rename(columns={'id': 'id_from_ontology_id', 'graph_int_id': 'id'}, inplace=True)
-    
-
-    if scenegraph:
-        # the name has to be the id
-        nodes_df.rename(columns={'name': 'name_label'}, inplace=True)
-        nodes_df['name'] = nodes_df['id'].copy()
-
 
     # if the name is missing, we fill it with an empty string because vega gives an error if it is missing
     nodes_df['name'] = nodes_df['name'].fillna('')
 
+    return nodes_df[['id', 'name', 'parent', 'type', 'ontology_id', 'id_from_ontology_id', 'color', 'organ']]
 
 
-    # from the female wing we remove the prostate
-    if only_female and not only_male:
-        nodes_df = nodes_df[nodes_df['organ']!='prostate']
-        fn = filename + '_female'
+def get_vega_node_values(node_table, scenegraph=False):
+    '''
+    The rows of the node table as the list of dictionaries Vega expects at config['data'][0]['values'].
+    The body (id 0) has no parent. If `scenegraph` is True, the name of every node is its id, this is necessary
+    to later get the coordinates of the nodes based on the IDs.
+    '''
+    values = node_table.to_dict(orient='records')
+    for value in values:
+        if value['id'] == 0:
+            del value['parent']
+        if scenegraph:
+            value['name'] = value['id']
+    return values
 
-    # from the male wing we remove the ovaries, fallopian tube, uterus, placenta
-    elif only_male and not only_female:
-        nodes_df = nodes_df[~nodes_df['organ'].isin(['fallopian_tube', 'ovary', 'uterus', 'placenta'])]
-        fn = filename + '_male'
 
+def get_wing_mask(node_table, only_female=False, only_male=False):
+    '''
+    The rows of the node table in a wing: the female wing has no prostate, the male wing no ovaries, fallopian tube,
+    uterus or placenta, and with neither flag all the rows are kept.
+    '''
+    if only_female and not only_male:
+        return (~node_table['organ'].isin(MALE_ORGANS)).to_numpy()
+    elif only_male and not only_female:
+        return (~node_table['organ'].isin(FEMALE_ORGANS)).to_numpy()
     elif not only_female and not only_male:
-        fn = filename + '_full'
+        return np.ones(len(node_table), dtype=bool)
+    else:
+        raise ValueError('The parameters `only_female` and `only_male` cannot be both True at the same time.')
 
+
+def get_wing_filter(only_female=False, only_male=False):
+    '''The Vega expression of `get_wing_mask`, None if all the rows are kept.'''
+    if only_female and not only_male:
+        return f'indexof({json.dumps(MALE_ORGANS)}, datum.organ) < 0'
+    elif only_male and not only_female:
+        return f'indexof({json.dumps(FEMALE_ORGANS)}, datum.organ) < 0'
+    elif not only_female and not only_male:
+        return None
     else:
         raise ValueError('The parameters `only_female` and `only_male` cannot be both True at the same time.')
 
-    # print(nodes_df['organ'].value_counts())
 
-    # create the json file for the nodes
-    nodes_json = nodes_df[['id', 'name', 'parent', 'type', 'ontology_id', 
-                           'id_from_ontology_id', 'color', 'organ', #'organ_label'
-                           ]].to_dict(orient='index')
+def write_vega_nodes(values, path):
+    '''Write the node values once for all the configs that refer to them, as a JSON array with one node per line.'''
+    with open(path, "w") as outfile:
+        outfile.write('[\n' + ',\n'.join(json.dumps(value, separators=(',', ':')) for value in values) + '\n]\n')
+        print(f'File saved as "{path}"')
+
+
+def get_external_node_data(data, nodes_url, only_female=False, only_male=False, scenegraph=False):
+    '''
+    The node data set (config['data'][0]) of a config that reads the nodes written by `write_vega_nodes` from
+    `nodes_url` and selects the rows of its wing with a filter transform, instead of holding them in 'values'.
+    If `scenegraph` is True, a formula transform sets the name of every node to its id.
+    '''
+    transform = []
+    wing_filter = get_wing_filter(only_female, only_male)
+    if wing_filter:
+        transform.append({'type': 'filter', 'expr': wing_filter})
+    if scenegraph:
+        transform.append({'type': 'formula', 'expr': 'datum.id', 'as': 'name'})
+
+    data = {key: value for key, value in data.items() if key != 'values'}
+    return {**data, 'url': nodes_url, 'format': {'type': 'json'}, 'transform': transform + data.get('transform', [])}
+
 
-    # the body does not have a parent, so we delete its value
-    del(nodes_json[0]['parent'])
+def load_vega_template(path='./data/vega_config.json'):
+    with open(path, encoding='utf8') as json_file:
+        return json.load(json_file)
 
-    # we need to convert the dictionary to a list, that's how the vega visualization expects it at the config['data'][0]['values']
-    nodes_json = [nodes_json[i] for i in nodes_json.keys()]
-    
-    # load the vega config file
-    with open('./data/vega_config.json', encoding='utf8') as json_file:
-        config = json.load(json_file)
 
-    # set the data in the config file
-    config['data'][0]['values'] = nodes_json
-    
+def get_vega_config_path(filename, only_female=False, only_male=False, output_dir=OUTPUT_DIR):
+    suffix = '_female' if only_female else ('_male' if only_male else '_full')
+    return f"{output_dir}/{filename}{suffix}_vega_viz_config.json"
+
+
+def create_vega_config(template, values, filename, only_female=False, only_male=False, show_labels=False, output_dir=OUTPUT_DIR,
+                       nodes_url=None, scenegraph=False):
+    '''
+    Put the node values of one variant into a copy of the Vega template and save it as compact JSON.
+
+    `values` are shared with the other variants and must not be changed. If `nodes_url` is set, the saved file
+    refers to the nodes at that url (see `get_external_node_data`, `scenegraph` is needed for it) instead of
+    holding them; the returned config always holds them.
+    '''
+    config = {**template, 'data': [{**template['data'][0], 'values': values}] + template['data'][1:]}
+
     # show labels if show_labels is True
     if show_labels:
+        config['marks'] = copy.deepcopy(template['marks'])
         config['marks'][-1]['encode']['update']['opacity']['signal'] = config['marks'][-1]['encode']['update']['opacity']['signal'][:-1] + '1' # show the labels, by default they are hidden
-    
+
     # create the json file and save it
-    with open(f"{OUTPUT_DIR}/{fn}_vega_viz_config.json", "w") as outfile:
-        outfile.write(json.dumps(config, indent=4))
-        print(f'File saved as "{OUTPUT_DIR}/{fn}_vega_viz.json"')
-    
+    path = get_vega_config_path(filename, only_female, only_male, output_dir)
+    saved = config
+    if nodes_url:
+        saved = {**config, 'data': [get_external_node_data(template['data'][0], nodes_url, only_female, only_male, scenegraph)] + config['data'][1:]}
+    with open(path, "w") as outfile:
+        outfile.write(json.dumps(saved, separators=(',', ':')))
+        print(f'File saved as "{path}"')
+
     return config
 
 
+# The node file the configs refer to when `create_vega_configs` writes the nodes once, relative to the configs
+VEGA_NODES_FILE = 'vega_nodes.json'
 
-vega_config = construct_network_create_vega_viz(pruned_nodes, pruned_edges, scenegraph=True)
+# The Vega configs written by `create_vega_configs`: (filename, only_female, only_male, scenegraph, show_labels)
+VEGA_CONFIGS = {
+    'full': ('butterfly', False, False, True, False),
+    'female_with_names': ('butterfly_names', True, False, False, True), #name shown - this one is not used just for manual checking with human readable names
+    'female_with_ids': ('butterfly_ids', True, False, True, True), #id shown - this is used for the coordinates
+    'female': ('butterfly', True, False, True, False), #no name or id shown, based on id (scenegraph) - this is used for the viz
+    'male': ('butterfly', False, True, True, False),
+    'male_with_ids': ('butterfly_ids', False, True, True, True), #id shown - this is used for the coordinates
+}
 
 
+def create_vega_configs(partonomy, output_dir=OUTPUT_DIR, external_nodes=False):
+    '''
+    Create the Vega config files of all the variants in `VEGA_CONFIGS` from the pruned partonomy.
 
-vega_config_female_with_names = construct_network_create_vega_viz(pruned_nodes, pruned_edges, 
-                                                                  only_female=True, scenegraph=False, 
-                                                                  show_labels=True, filename='butterfly_names') #name shown - this one is not used just for manual checking with human readable names
+    The node table, its values with names and with ids, the wing masks and the template are made once;
+    a variant only selects its rows and writes its file. The variants share the dictionaries of their nodes.
+    If `external_nodes` is True, the nodes are written once to `VEGA_NODES_FILE` and the config files refer to it.
 
-vega_config_female_with_ids = construct_network_create_vega_viz(pruned_nodes, pruned_edges, 
-                                                                only_female=True, scenegraph=True, 
-                                                                show_labels=True, filename='butterfly_ids') #id shown - this is used for the coordinates 
+    Returns a dictionary from the variant to its config, with the nodes in it.
+    '''
+    node_table = get_vega_node_table(partonomy['pruned_nodes'], partonomy['pruned_edges'])
+    template = load_vega_template()
 
-vega_config_female = construct_network_create_vega_viz(pruned_nodes, pruned_edges, 
-                                                       only_female=True, scenegraph=True, 
-                                                       show_labels=False) #no name or id shown, based on id (scenegraph) - this is used for the viz
+    values = {}
+    if external_nodes:
+        values[False] = get_vega_node_values(node_table, scenegraph=False)
+        write_vega_nodes(values[False], f'{output_dir}/{VEGA_NODES_FILE}')
 
+    masks = {}
+    configs = {}
+    for variant, (filename, only_female, only_male, scenegraph, show_labels) in VEGA_CONFIGS.items():
+        if scenegraph not in values:
+            values[scenegraph] = get_vega_node_values(node_table, scenegraph)
+        if (only_female, only_male) not in masks:
+            masks[only_female, only_male] = get_wing_mask(node_table, only_female, only_male)
 
-vega_config_male = construct_network_create_vega_viz(pruned_nodes, pruned_edges, 
-                                                     only_male=True, scenegraph=True)
+        variant_values = [value for value, keep in zip(values[scenegraph], masks[only_female, only_male]) if keep]
+        configs[variant] = create_vega_config(template, variant_values, filename, only_female=only_female, only_male=only_male,
+                                              show_labels=show_labels, output_dir=output_dir,
+                                              nodes_url=VEGA_NODES_FILE if external_nodes else None, scenegraph=scenegraph)
+    return configs
 
-vega_config_male_with_ids = construct_network_create_vega_viz(pruned_nodes, pruned_edges, 
-                                                              only_male=True, scenegraph=True, show_labels=True, 
-                                                              filename='butterfly_ids') #id shown - this is used for the coordinates 
 
 
+def save_vega_viz(rendered, filename, scenegraph=False, output_dir=OUTPUT_DIR):
+    '''Save a rendered SVG string, or a scenegraph dictionary if `scenegraph` is True.'''
+    if scenegraph:
+        with open(f"{output_dir}/vega_{filename}_scenegraph.json", "w") as outfile:
+            outfile.write(json.dumps(rendered, indent=4))
+    else:
+        with open(f"{output_dir}/vega_{filename}_viz.svg", "wt") as f:
+            f.write(rendered)
 
-def create_vega_viz(config, filename, scenegraph=False):
-    '''
-    Create the visualization based on the vega config file. The visualization can be saved as SVG or as a scenegraph JSON file.
 
-    Parameters:
-    config: dict
-        The vega config file.
-    filename: str
-        The name of the file to be saved.
-    scenegraph: bool
-        If True, the scenegraph JSON file will be saved, otherwise the SVG file will be saved.
-    '''
+def get_node_coordinates(scenegraph):
+    return {item['text']: (item['x'], item['y']) for item in scenegraph['scenegraph']['items'][0]['items'][2]['items']}
 
-    if scenegraph:
-        scenegraph_data = vlc.vega_to_scenegraph(vg_spec=config)
 
-        with open(f"{OUTPUT_DIR}/vega_{filename}_scenegraph.json", "w") as outfile:
-            outfile.write(json.dumps(scenegraph_data, indent=4))
+def render_vega(configs, output_dir=OUTPUT_DIR, cache_dir=VEGA_CACHE_DIR, workers=1):
+    '''
+    Render the SVGs of the two wings in one batch, reading the ones rendered before from the cache in `cache_dir`.
+    '''
+    wings = ['female', 'male']
+    renderer = VegaRenderer(cache_dir or None, workers)
+    for wing, svg in zip(wings, renderer.render([(configs[wing], 'svg') for wing in wings])):
+        save_vega_viz(svg, wing, output_dir=output_dir)
+    print(renderer.report())
 
-        return scenegraph_data
-    
-    else:
-        svg_str = vlc.vega_to_svg(vg_spec=config,)
 
-        with open(f"{OUTPUT_DIR}/vega_{filename}_viz.svg", "wt") as f:
-            f.write(svg_str)
+def get_wing_coordinates(configs):
+    '''
+    Get the coordinates of the nodes of the two wings from the radial layout of their Vega configs.
 
-        return svg_str
-    
+    Returns a dictionary from the wing ('female', 'male') to the coordinates of its nodes.
+    '''
+    return {wing: get_layout_coordinates(configs[f'{wing}_with_ids']) for wing in ['female', 'male']}
 
 
-# Create the vega viz of the female wing
-female_svg = create_vega_viz(vega_config_female, 'female', scenegraph=False)
+def check_layout_parity(configs, coordinates, output_dir=OUTPUT_DIR, tolerance=1e-6, renderer=None):
+    '''
+    Compare the coordinates of `get_wing_coordinates` with the ones in the Vega scenegraphs of the configs.
+    Raises a ValueError if a node is missing or a coordinate differs by more than `tolerance` pixels.
+    '''
+    wings = ['female', 'male']
+    renderer = renderer or VegaRenderer()
+    scenegraphs = renderer.render([(configs[f'{wing}_with_ids'], 'scenegraph') for wing in wings])
+    for wing, scenegraph in zip(wings, scenegraphs):
+        save_vega_viz(scenegraph, f'{wing}_id', scenegraph=True, output_dir=output_dir)
+        expected = get_node_coordinates(scenegraph)
+        if expected.keys() != coordinates[wing].keys():
+            raise ValueError(f'The {wing} wing has {len(coordinates[wing])} nodes, the Vega scenegraph has {len(expected)}.')
+
+        difference = np.abs(np.array([coordinates[wing][node] for node in expected]) - np.array(list(expected.values())))
+        print(f'{wing} wing: the largest difference to the Vega coordinates is {difference.max():.3g} pixels')
+        if difference.max() > tolerance:
+            raise ValueError(f'The {wing} wing coordinates differ from the Vega coordinates by up to {difference.max():.3g} pixels.')
+
+
+def get_heart_chambers(blood_nodes):
+    '''
+    The integer IDs of the blood nodes named after the left (atrium, ventricle) and the right side of the heart.
+    '''
+    blood_node_names = blood_nodes['name'].astype(str).str.lower()
+    left = blood_nodes[blood_node_names.str.contains('left cardiac atrium|left ventricle')]['graph_int_id'].tolist()
+    right = blood_nodes[blood_node_names.str.contains('right cardiac atrium|right ventricle')]['graph_int_id'].tolist()
+    return left, right
 
-# Create the vega viz of the male wing
-male_svg = create_vega_viz(vega_config_male, 'male', scenegraph=False)
 
+def classify_arteries_and_veins(blood_graph, heart, left_side, right_side):
+    '''
+    Classify the nodes of the blood graph as arteries and veins. Without the heart, the graph falls apart into
+    components: the arteries leave the left side of the heart and the veins return to its right side. Every
+    component is labelled once and its nodes get the label of their component.
 
-# Get the scenegraphs for the coordinates
-scenegraph_female = create_vega_viz(vega_config_female_with_ids, 'female_id', scenegraph=True)
-scenegraph_male = create_vega_viz(vega_config_male_with_ids, 'male_id', scenegraph=True)
+    Parameters:
+    blood_graph: nx.Graph
+        The blood vasculature graph.
+    heart: int
+        The heart node, it is labelled as an artery.
+    left_side, right_side: list
+        The nodes of the left and the right side of the heart (atrium and ventricle).
+
+    Returns a dictionary from node to label: 'artery' or 'vein' for the components with nodes of only one side
+    of the heart, 'ambiguous' for the components with nodes of both sides or of neither, and 'unreached' for
+    the components that are not connected to the heart.
+    '''
+    left_side, right_side = set(left_side), set(right_side)
+    neighbors_of_heart = set(blood_graph[heart])
 
+    without_heart = blood_graph.copy()
+    without_heart.remove_node(heart)
 
-def get_node_coordinates(scenegraph):
-    return {item['text']: (item['x'], item['y']) for item in scenegraph['scenegraph']['items'][0]['items'][2]['items']}
+    labels = {heart: 'artery'}
+    for component in nx.connected_components(without_heart):
+        has_left, has_right = not component.isdisjoint(left_side), not component.isdisjoint(right_side)
 
+        if component.isdisjoint(neighbors_of_heart):
+            label = 'unreached'
+        elif has_left != has_right:
+            label = 'artery' if has_left else 'vein'
+        else:
+            label = 'ambiguous'
 
-coordinates_of_nodes_fem = get_node_coordinates(scenegraph_female)
-coordinates_of_nodes_mal = get_node_coordinates(scenegraph_male)
+        labels.update(dict.fromkeys(component, label))
 
+    return labels
 
-#######################################################################################################################
-#######################################################################################################################
 
-# Vascular network
+def load_blood_network(partonomy, blood_edges_url):
+    '''
+    Load the blood vasculature network and classify its nodes as arteries and veins.
 
-blood_edges = pd.read_csv(blood_edges_url)
+    Parameters:
+    partonomy: dict
+        The result of `load_partonomy`.
+    blood_edges_url: str
+        The blood vasculature edges table written by build-network.py.
+
+    Returns a dictionary with the blood nodes (with the 'artery/vein' column), the integer blood graph and its
+    BFS tree from the heart (`blood_tree`), the integer ID of the heart, the partonomy nodes that are also blood
+    nodes (`matching_nodes`) and the blood nodes that could not be classified (`unclassified_blood_nodes`).
+    '''
+    nodes = partonomy['nodes']
+    node_lookup = partonomy['node_lookup']
 
-blood_graph = nx.from_pandas_edgelist(blood_edges, source='source', target='target', edge_attr=True,)# create_using=nx.DiGraph)
+    blood_edges = read_table(blood_edges_url)
 
-blood_nodes = nodes[nodes['id'].isin(blood_graph.nodes)]
+    blood_graph = nx.from_pandas_edgelist(blood_edges, source='source', target='target', edge_attr=True,)# create_using=nx.DiGraph)
 
-blood_nodes['graph_int_id'] = blood_nodes['id'].map(id_to_graph_int_id)
+    blood_nodes = nodes[nodes['id'].isin(blood_graph.nodes)].copy()
 
-blood_edges['source_int'] = blood_edges['source'].map(id_to_graph_int_id)
-blood_edges['target_int'] = blood_edges['target'].map(id_to_graph_int_id)
+    blood_nodes['graph_int_id'] = node_lookup.get_graph_int_ids(blood_nodes['id'])
 
+    blood_edges['source_int'] = node_lookup.get_graph_int_ids(blood_edges['source'])
+    blood_edges['target_int'] = node_lookup.get_graph_int_ids(blood_edges['target'])
 
-blood_graph_int = nx.from_pandas_edgelist(blood_edges, source='source_int', target='target_int', edge_attr=True)
 
+    blood_graph_int = nx.from_pandas_edgelist(blood_edges, source='source_int', target='target_int', edge_attr=True)
 
-id_of_heart = blood_nodes[blood_nodes['name']=='heart']['graph_int_id'].values[0]
 
-blood_nodes[blood_nodes['graph_int_id'].isin(list(nx.neighbors(blood_graph_int, id_of_heart)))]
+    # the exact name among the blood nodes, the table is small enough to scan
+    id_of_heart = blood_nodes[blood_nodes['name']=='heart']['graph_int_id'].values[0]
 
+    # the BFS tree from the heart answers the ancestor queries of both wings
+    blood_tree = CompactTree.from_edges(blood_edges['source_int'], blood_edges['target_int'], root=id_of_heart)
 
-components = blood_graph_int.copy()
-components.remove_node(id_of_heart)
-components = list(nx.connected_components(components))
 
-components += [set([id_of_heart])]
+    id_of_left_ventricle_and_left_atrium, id_of_right_ventricle_and_right_atrium = get_heart_chambers(blood_nodes)
 
 
-id_of_left_ventricle_and_left_atrium = blood_nodes[blood_nodes['name'].apply(lambda x: 'left cardiac atrium' in str(x).lower() or 'left ventricle' in str(x).lower())]['graph_int_id'].tolist()
+    artery_or_vein = classify_arteries_and_veins(blood_graph_int, id_of_heart, id_of_left_ventricle_and_left_atrium, id_of_right_ventricle_and_right_atrium)
 
-id_of_right_ventricle_and_right_atrium = blood_nodes[blood_nodes['name'].apply(lambda x: 'right cardiac atrium' in str(x).lower() or 'right ventricle' in str(x).lower())]['graph_int_id'].tolist()
+    # nodes missing from the blood graph are not connected to the heart either
+    blood_nodes['artery/vein'] = blood_nodes['graph_int_id'].map(artery_or_vein).fillna('unreached')
 
+    unclassified_blood_nodes = blood_nodes[~blood_nodes['artery/vein'].isin(['artery', 'vein'])]
+    if len(unclassified_blood_nodes) > 0:
+        print(f"{len(unclassified_blood_nodes)} blood nodes are neither arteries nor veins and are left out of the blood network:")
+        print(unclassified_blood_nodes[['id', 'name', 'artery/vein']].to_string(index=False))
 
-blood_nodes['artery/vein'] = blood_nodes['graph_int_id'].apply(lambda x: 'artery' if set(id_of_left_ventricle_and_left_atrium+[id_of_heart]).intersection(set([comp for comp in components if x in comp][0])) else 'vein')
 
+    # those nodes whose ontology id is in both blood and whole graph but not in 'blood_vasculature' organ
+    nodes_except_blood = nodes[nodes['organ']!='blood_vasculature']
+    # matching nodes between blood vasculature and other organs
+    matching_nodes = nodes_except_blood[nodes_except_blood['id'].isin(blood_nodes['id'])]
 
-# those nodes whose ontology id is in both blood and whole graph but not in 'blood_vasculature' organ
-nodes_except_blood = nodes[nodes['organ']!='blood_vasculature']
-# matching nodes between blood vasculature and other organs
-matching_nodes = nodes_except_blood[nodes_except_blood['id'].isin(blood_nodes['id'])]
+    return {
+        'blood_nodes': blood_nodes,
+        'blood_graph_int': blood_graph_int,
+        'blood_tree': blood_tree,
+        'id_of_heart': id_of_heart,
+        'matching_nodes': matching_nodes,
+        'unclassified_blood_nodes': unclassified_blood_nodes,
+    }
 
 
 
-def get_coordinates_for_blood_nodes(coordinates_of_nodes, only_female=False, only_male=False, bundle_edges=False):
+def get_coordinates_for_blood_nodes(blood, coordinates_of_nodes, only_female=False, only_male=False, seed=42, iterations=1000, threshold=1e-4,
+                                    tolerance=None):
     '''
     Get the coordinates of the blood nodes based on the coordinates of the partonomy graph nodes.
 
     Parameters:
+    blood: dict
+        The result of `load_blood_network`.
     coordinates_of_nodes: dict
         The dictionary containing the coordinates of the nodes.
     only_female: bool
         If True, the visualization will not contain the prostate (so far that's the only male organ).
     only_male: bool
         If True, the visualization will not contain the ovaries, fallopian tube, uterus, placenta.
-    bundle_edges: bool
-        If True, the edges will be bundled (for the final viz, this is used).
-
+    seed: int
+        The seed of the spring layout.
+    iterations: int
+        The largest number of iterations of the spring layout.
+    threshold: float
+        The spring layout stops when the movement of the nodes, divided by their number, falls below it.
+    tolerance: float
+        If set, the spring layout also stops when the largest displacement of a free node, before it is capped, falls
+        below this fraction of the size of the canvas. None runs the same iterations as `nx.spring_layout`.
+
+    Returns the graphs of the veins and the arteries, the positions of their nodes and the statistics of their layouts.
     '''
+    blood_nodes = blood['blood_nodes']
+    blood_graph_int = blood['blood_graph_int']
+    id_of_heart = blood['id_of_heart']
+    matching_nodes = blood['matching_nodes']
+    blood_tree = blood['blood_tree']
 
-    if only_female and not only_male:
-        matching_nodes_filtered = matching_nodes[matching_nodes['organ']!='prostate'].copy()
-        filename='female'
-
-    elif only_male and not only_female:
-        matching_nodes_filtered = matching_nodes[~matching_nodes['organ'].isin(['fallopian_tube', 'ovary', 'uterus', 'placenta'])].copy()
-        filename='male'
-
-    else:
+    if only_female == only_male:
         raise ValueError('Set either only_female or only_male parameters True')
-    
-    
-    #Get the pruned blood graph
+    matching_nodes_filtered = matching_nodes[get_wing_mask(matching_nodes, only_female, only_male)].copy()
 
-    parents = set(matching_nodes_filtered['graph_int_id'].tolist())
 
-    # get the parent of each node for the tree layout
-    blood_parents_dict = dict(nx.bfs_predecessors(blood_graph_int, source=262))
-
-    pruned_blood_nodes = parents.copy()
-
-    while len(parents)>0:
-        parents = set([blood_parents_dict[node] for node in parents if node in blood_parents_dict]) - pruned_blood_nodes
+    #Get the pruned blood graph
 
-        pruned_blood_nodes = pruned_blood_nodes.union(parents)
+    parents = matching_nodes_filtered['graph_int_id'].tolist()
 
+    # the matching nodes and all of their ancestors in the BFS tree of the blood graph from the heart
+    pruned_blood_nodes = set(parents) | set(blood_tree.ids[blood_tree.ancestors(parents)].tolist())
 
-    
-    pruned_blood_nodes = blood_nodes[blood_nodes['graph_int_id'].isin(pruned_blood_nodes)]
+    pruned_blood_nodes = blood_nodes[blood_nodes['graph_int_id'].isin(pruned_blood_nodes)].copy()
 
     pruned_blood_graph = nx.induced_subgraph(blood_graph_int, pruned_blood_nodes['graph_int_id'].tolist())
 
     veins = blood_nodes[blood_nodes['artery/vein']=='vein']['graph_int_id'].tolist()
     arteries = blood_nodes[blood_nodes['artery/vein']=='artery']['graph_int_id'].tolist()
 
-    graphs = {'veins': nx.induced_subgraph(pruned_blood_graph, veins+[id_of_heart]), 'arteries': nx.induced_subgraph(pruned_blood_graph, arteries)}
+    # copies of the subgraph views: a view iterates its nodes in the order of its node set, which is not kept when the
+    # cached result is unpickled, so a layout read from the cache would be bundled in another edge order
+    graphs = {'veins': nx.induced_subgraph(pruned_blood_graph, veins+[id_of_heart]).copy(),
+              'arteries': nx.induced_subgraph(pruned_blood_graph, arteries).copy()}
 
 
     # get the coordinates of the nodes
-    pruned_blood_nodes['coordinates'] = pruned_blood_nodes['graph_int_id'].apply(lambda x: coordinates_of_nodes[x] if x in coordinates_of_nodes else np.nan)
+    pruned_blood_nodes['coordinates'] = pruned_blood_nodes['graph_int_id'].map(coordinates_of_nodes)
 
     pruned_blood_nodes = pruned_blood_nodes.dropna(subset=['coordinates'])
 
     pruned_blood_nodes.set_index('graph_int_id', inplace=True)
 
-    coordinates = {'veins': pruned_blood_nodes[(pruned_blood_nodes['artery/vein']=='vein')|(pruned_blood_nodes['name']=='heart')]['coordinates'].to_dict(), 
+    coordinates = {'veins': pruned_blood_nodes[(pruned_blood_nodes['artery/vein']=='vein')|(pruned_blood_nodes['name']=='heart')]['coordinates'].to_dict(),
                    'arteries': pruned_blood_nodes[pruned_blood_nodes['artery/vein']=='artery']['coordinates'].to_dict()}
 
-    fixed_nodes = {'veins': pruned_blood_nodes[(pruned_blood_nodes['artery/vein']=='vein')|(pruned_blood_nodes['name']=='heart')].index.tolist(), 
+    fixed_nodes = {'veins': pruned_blood_nodes[(pruned_blood_nodes['artery/vein']=='vein')|(pruned_blood_nodes['name']=='heart')].index.tolist(),
                    'arteries': pruned_blood_nodes[pruned_blood_nodes['artery/vein']=='artery'].index.tolist()}
 
-    pos = {}
+    # only the nodes without Vega coordinates move, the same layout as nx.spring_layout with these nodes fixed
+    pos, stats = {}, {}
+    for vessels in ['veins', 'arteries']:
+        pos[vessels], stats[vessels] = constrained_spring_layout(graphs[vessels], coordinates[vessels], fixed_nodes[vessels],
+                                                                 k=0.01/np.sqrt(len(graphs[vessels])), iterations=iterations,
+                                                                 threshold=threshold, seed=seed, tolerance=tolerance)
+        print(f"{vessels}: {stats[vessels]['free_nodes']} free nodes, {stats[vessels]['iterations']} iterations, "
+              f"last displacement {stats[vessels]['displacement']:.3g} of the canvas, final energy {stats[vessels]['energy']:.6g}")
 
-    pos['veins'] = nx.spring_layout(graphs['veins'], pos=coordinates['veins'], fixed=fixed_nodes['veins'], seed=42, iterations=1000, dim=2, k=0.01/np.sqrt(len(graphs['veins'])))
-    pos['arteries'] = nx.spring_layout(graphs['arteries'], pos=coordinates['arteries'], fixed=fixed_nodes['arteries'], seed=42, iterations=1000, dim=2, k=0.01/np.sqrt(len(graphs['arteries'])))
+    return {'graphs': graphs, 'pos': pos, 'id_of_heart': id_of_heart, 'stats': stats}
 
 
-    # return graphs, pos, fixed_nodes
+def draw_blood_network(layout, filename, bundle_edges=False, initial_bandwidth=.015, decay=0.8, tension=0.99, accuracy=1000, output_dir=OUTPUT_DIR,
+                       bundle_cache_dir=None, bundle_cache_size=256 * 2**20, svg_precision=2, svg_tolerance=0.15):
+    '''
+    Draw the blood network of one wing on the canvas of the Vega visualization.
+
+    Parameters:
+    layout: dict
+        The result of `get_coordinates_for_blood_nodes`.
+    filename: str
+        The wing ('female' or 'male'), used in the name of the file.
+    bundle_edges: bool
+        If True, the edges will be bundled (for the final viz, this is used) and saved as SVG, otherwise the graph is saved as PDF.
+    initial_bandwidth, decay, tension, accuracy: float
+        The parameters of the hammer bundling.
+    output_dir: str
+        The directory of the file.
+    bundle_cache_dir: str
+        The directory of the `BundleCache` of the hammer bundling, by default the bundling is not cached.
+    bundle_cache_size: int
+        The largest size of the bundling cache in bytes.
+    svg_precision: int
+        The number of decimals of the coordinates in the SVG of the bundled edges.
+    svg_tolerance: float
+        How far (in pixels of the canvas) a point left out of the bundled edges by their simplification can be from them,
+        0 keeps all the points.
+    '''
+    graphs = layout['graphs']
+    pos = layout['pos']
+    id_of_heart = layout['id_of_heart']
 
     if not bundle_edges:
+        # only the PDF needs matplotlib, the bundled SVG is written directly
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(17.2,17.2))
         plt.axes().set_aspect('equal')
         plt.margins(x=0, y=0)
@@ -463,7 +801,7 @@ def get_coordinates_for_blood_nodes(coordinates_of_nodes, only_female=False, onl
         plt.ylim(0, 1720)
         plt.subplots_adjust(left=0, right=1, top=1, bottom=0, hspace=0, wspace=0)
         plt.tight_layout(pad=0, h_pad=0, w_pad=0, rect=(0,0,1,1))
-        plt.axis('off') 
+        plt.axis('off')
 
         nx.draw(graphs['arteries'], pos=pos['arteries'], node_size=10, edge_color='tab:red', node_color='tab:red')
         nx.draw(graphs['veins'], pos=pos['veins'], node_size=10, edge_color='tab:blue', node_color='tab:blue')
@@ -477,80 +815,191 @@ def get_coordinates_for_blood_nodes(coordinates_of_nodes, only_female=False, onl
         plt.margins(0,0)
         plt.gca().xaxis.set_major_locator(plt.NullLocator())
         plt.gca().yaxis.set_major_locator(plt.NullLocator())
-        plt.savefig(f'{OUTPUT_DIR}/blood_viz_{filename}.pdf',  transparent=True, pad_inches=0.0, bbox_inches=0)
-        print(f'Fig saved as "{OUTPUT_DIR}/blood_viz_{filename}.pdf"')
+        plt.savefig(f'{output_dir}/blood_viz_{filename}.pdf',  transparent=True, pad_inches=0.0, bbox_inches=0)
+        print(f'Fig saved as "{output_dir}/blood_viz_{filename}.pdf"')
         plt.show()
 
     else:
-        # nodes_only = {'veins': pd.DataFrame.from_dict(relabel_mapping_inv['veins'], orient='index').rename(columns={0:'name'}), 
+        # nodes_only = {'veins': pd.DataFrame.from_dict(relabel_mapping_inv['veins'], orient='index').rename(columns={0:'name'}),
         #     'arteries': pd.DataFrame.from_dict(relabel_mapping_inv['arteries'], orient='index').rename(columns={0:'name'})}
-        
-        # nodes = {'veins': pd.DataFrame.from_dict(pos2['veins']).T.rename(columns={0:'x', 1:'y'}).join(nodes_only['veins'])[['name', 'x', 'y']], 
+
+        # nodes = {'veins': pd.DataFrame.from_dict(pos2['veins']).T.rename(columns={0:'x', 1:'y'}).join(nodes_only['veins'])[['name', 'x', 'y']],
         #          'arteries': pd.DataFrame.from_dict(pos2['arteries']).T.rename(columns={0:'x', 1:'y'}).join(nodes_only['arteries'])[['name', 'x', 'y']]}
-        
-        # edges = {'veins': nx.to_pandas_edgelist(renamed_comp['veins'])[['source', 'target']], 
+
+        # edges = {'veins': nx.to_pandas_edgelist(renamed_comp['veins'])[['source', 'target']],
         #          'arteries': nx.to_pandas_edgelist(renamed_comp['arteries'])[['source', 'target']]}
         # hb = hammer_bundle(nodes, edges, initial_bandwidth=0.03,tension=0.9, accuracy=8000)
         edges = {'veins': nx.to_pandas_edgelist(graphs['veins'], source='source_int', target='target_int')[['source_int', 'target_int']].rename(columns={'source_int': 'source', 'target_int': 'target'}),
                  'arteries': nx.to_pandas_edgelist(graphs['arteries'],  source='source_int', target='target_int')[['source_int', 'target_int']].rename(columns={'source_int': 'source', 'target_int': 'target'}),
                  }
-        nodes = {'veins': pd.DataFrame.from_dict(pos['veins']).T.rename(columns={0:'x', 1:'y'}),#.reset_index(names=['name']),#.join(pruned_blood_nodes[['name', 'artery/vein']]), 
+        nodes = {'veins': pd.DataFrame.from_dict(pos['veins']).T.rename(columns={0:'x', 1:'y'}),#.reset_index(names=['name']),#.join(pruned_blood_nodes[['name', 'artery/vein']]),
                  'arteries': pd.DataFrame.from_dict(pos['arteries']).T.rename(columns={0:'x', 1:'y'})#.join(pruned_blood_nodes[['name', 'artery/vein']])
                  }
-        
-        
-        hb = {'veins': hammer_bundle(nodes['veins'], edges['veins'], initial_bandwidth=.015, decay=0.8, tension=0.99, accuracy=1000), 
-              'arteries': hammer_bundle(nodes['arteries'], edges['arteries'], initial_bandwidth=.015, decay=0.8, tension=0.99, accuracy=1000)}
-        
-        plt.figure(figsize=(17.2, 17.2))
-        plt.axes().set_aspect('equal')
-        plt.margins(x=0, y=0)
-        plt.xlim(0,1720)
-        plt.ylim(-1720, 0)
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0, hspace=0, wspace=0)
-        plt.tight_layout(pad=0, h_pad=0, w_pad=0, rect=(0,0,1,1))
-        plt.axis('off')
 
-        plt.plot(hb['veins']['x'], -hb['veins']['y'], color='tab:blue', alpha=0.8)
-        plt.plot(hb['arteries']['x'], -hb['arteries']['y'], color='tab:red', alpha=0.8)
 
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-        plt.tight_layout(pad=0, h_pad=0, w_pad=0, rect=(0,0,1,1))
-        plt.axis('off')
-        plt.gca().set_axis_off()
-        plt.subplots_adjust(top = 1, bottom = 0, right = 1, left = 0, hspace = 0, wspace = 0)
-        plt.margins(0,0)
-        plt.gca().xaxis.set_major_locator(plt.NullLocator())
-        plt.gca().yaxis.set_major_locator(plt.NullLocator())
-        
-        plt.savefig(f'{OUTPUT_DIR}/blood_viz_{filename}_bundled.svg', pad_inches=0.0, transparent=True, bbox_inches=0)
-        print(f'Fig saved as "{OUTPUT_DIR}/blood_viz_{filename}_bundled.svg"')
-        plt.show()
-    
-        
-get_coordinates_for_blood_nodes(coordinates_of_nodes_fem, only_female=True, bundle_edges=True)
+        if bundle_cache_dir:
+            cache = BundleCache(bundle_cache_dir, max_bytes=bundle_cache_size)
+            bundle = cache.bundle
+        else:
+            cache, bundle = None, hammer_bundle
 
+        hb = {'veins': bundle(nodes['veins'], edges['veins'], initial_bandwidth=initial_bandwidth, decay=decay, tension=tension, accuracy=accuracy),
+              'arteries': bundle(nodes['arteries'], edges['arteries'], initial_bandwidth=initial_bandwidth, decay=decay, tension=tension, accuracy=accuracy)}
+        if cache:
+            print(cache.report())
 
-get_coordinates_for_blood_nodes(coordinates_of_nodes_mal, only_male=True, bundle_edges=True)
+        # the paths go straight onto the 1720 x 1720 canvas of the Vega visualization (y grows downwards in both),
+        # the size of the document and the 1.5pt lines are those of the 17.2in matplotlib figure this replaces
+        stroke_width = 1.5 * 1720 / (17.2 * 72)
+        write_svg_paths(f'{output_dir}/blood_viz_{filename}_bundled.svg', [
+            (hb['veins'][['x', 'y']].to_numpy(), '#1f77b4', 0.8, stroke_width), # tab:blue
+            (hb['arteries'][['x', 'y']].to_numpy(), '#d62728', 0.8, stroke_width), # tab:red
+        ], size=1720, width=f'{17.2 * 72:g}pt', precision=svg_precision, tolerance=svg_tolerance)
+        print(f'Fig saved as "{output_dir}/blood_viz_{filename}_bundled.svg"')
 
 
 #######################################################################################################################
 
 # Overlay the two networks
-template = st.fromfile(f'{OUTPUT_DIR}/vega_female_viz.svg', )
-second_svg = st.fromfile(f'{OUTPUT_DIR}/blood_viz_female_bundled.svg')
+def overlay_wing(wing, output_dir=OUTPUT_DIR):
+    template = st.fromfile(f'{output_dir}/vega_{wing}_viz.svg')
+    template.set_size(size=('1720', '1720'))
+    second_svg = st.fromfile(f'{output_dir}/blood_viz_{wing}_bundled.svg')
+    second_svg.set_size(size=('1720', '1720'))
+
+    template.append(second_svg)
+    template.save(f'{output_dir}/{wing}_butterfly_wing.svg')
 
-template.set_size(size=('1720', '1720'))
-second_svg.set_size(size=('1720', '1720'))  
 
-template.append(second_svg)
-template.save(f'{OUTPUT_DIR}/female_butterfly_wing.svg')
+def run_wing(wing, coordinates, blood, rendered, args, output_dir=OUTPUT_DIR):
+    '''
+    Run the stages of one wing: the layout and the bundling of its blood network and the overlay on its Vega SVG.
+
+    `coordinates` and `blood` are the (key, result) pairs of the shared stages, `coordinates` only for this wing,
+    and `rendered` is the key of the stage that rendered the Vega SVGs. An error does not stop the other wing,
+    it is returned in the summary.
+
+    Returns a dictionary with the wing, the seconds it took and the traceback of the error (None if it worked).
+    '''
+    def stage(name, func, inputs, params={}, outputs=(), after=()):
+        return run_stage(name, func, inputs, params, outputs, after, cache_dir=args.cache_dir, force=args.force)
+
+    start = time.monotonic()
+    try:
+        layout = stage(f'layout_{wing}', get_coordinates_for_blood_nodes, {'blood': blood, 'coordinates_of_nodes': coordinates},
+                       {'only_female': wing == 'female', 'only_male': wing == 'male', 'seed': args.seed, 'iterations': args.layout_iterations,
+                        'threshold': args.layout_threshold, 'tolerance': args.layout_tolerance})
+
+        bundling = {'initial_bandwidth': args.bandwidth, 'decay': args.decay, 'tension': args.tension, 'accuracy': args.accuracy}
+        bundled = stage(f'bundle_{wing}', draw_blood_network, {'layout': layout},
+                        dict(bundling, filename=wing, bundle_edges=True, output_dir=output_dir, bundle_cache_dir=args.bundle_cache_dir,
+                             bundle_cache_size=int(args.bundle_cache_size * 2**20), svg_precision=args.svg_precision,
+                             svg_tolerance=args.svg_tolerance),
+                        [f'{output_dir}/blood_viz_{wing}_bundled.svg'])
+
+        # reads the SVGs written by the two stages before
+        stage(f'overlay_{wing}', overlay_wing, {}, {'wing': wing, 'output_dir': output_dir},
+              [f'{output_dir}/{wing}_butterfly_wing.svg'], after=[rendered, bundled[0]])
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return {'wing': wing, 'seconds': time.monotonic() - start, 'error': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the butterfly wings from the tables written by build-network.py.')
+    parser.add_argument('--version', default=VERSION, help='the release to visualize, read from ./data/<version>')
+    parser.add_argument('--output-dir', help='directory of the outputs (default: ./viz_<version>)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='directory of the cached stage results')
+    parser.add_argument('--force', action='store_true', help='run every stage even if its cached result is still valid')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the spring layout of the blood network')
+    parser.add_argument('--layout-iterations', type=int, default=1000, help='largest number of iterations of the spring layout')
+    parser.add_argument('--layout-threshold', type=float, default=1e-4,
+                        help='the spring layout stops when the movement of the nodes per node falls below it')
+    parser.add_argument('--layout-tolerance', type=float,
+                        help='also stop the spring layout when the largest displacement of a free node, before it is capped, '
+                             'falls below this fraction of the canvas (default: off, the same iterations as nx.spring_layout)')
+    parser.add_argument('--bandwidth', type=float, default=.015, help='initial bandwidth of the hammer bundling')
+    parser.add_argument('--decay', type=float, default=0.8, help='bandwidth decay of the hammer bundling')
+    parser.add_argument('--tension', type=float, default=0.99, help='tension of the hammer bundling')
+    parser.add_argument('--accuracy', type=int, default=1000, help='accuracy of the hammer bundling')
+    parser.add_argument('--svg-precision', type=int, default=2, help='decimals of the coordinates of the bundled edges in the SVG')
+    parser.add_argument('--svg-tolerance', type=float, default=0.15,
+                        help='largest distance in pixels of a point left out of the bundled edges by their simplification')
+    parser.add_argument('--bundle-cache-dir', default=BUNDLE_CACHE_DIR,
+                        help='directory of the cached hammer bundling results, an empty string turns the cache off')
+    parser.add_argument('--bundle-cache-size', type=float, default=256, help='largest size of the bundling cache in MB')
+    parser.add_argument('--external-node-data', action='store_true',
+                        help=f'write the Vega nodes once to {VEGA_NODES_FILE} and refer to it from the config files')
+    parser.add_argument('--vega-cache-dir', default=VEGA_CACHE_DIR,
+                        help='directory of the cached Vega SVGs and scenegraphs, an empty string turns the cache off')
+    parser.add_argument('--render-workers', type=int, default=1, help='render the Vega specs on this many threads')
+    parser.add_argument('--wing-workers', type=int, default=1, help='build the female and male wings on this many processes')
+    parser.add_argument('--check-layout', action='store_true',
+                        help='render the Vega scenegraphs and check the node coordinates against them')
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or './viz_' + args.version
+    data_dir = './data/' + args.version
+
+    if os.path.isdir(output_dir):
+        pass
+    else:
+        os.mkdir(output_dir)
+
+    def stage(name, func, inputs, params={}, outputs=(), after=()):
+        return run_stage(name, func, inputs, params, outputs, after, cache_dir=args.cache_dir, force=args.force)
+
+    nodes_path, edges_path, blood_edges_path = (f'{data_dir}/{table}.csv' for table in ['asct-nodes', 'asct-edges', 'asct-blood-vasculature-edges'])
+
+    partonomy = stage('partonomy', load_partonomy, {
+        'nodes_url': (get_table_hash(nodes_path), nodes_path),
+        'edges_url': (get_table_hash(edges_path), edges_path),
+    })
+
+    # `create_vega_configs` reads the Vega template through `load_vega_template`, the stage depends on its content
+    configs = stage('vega_configs', create_vega_configs, {'partonomy': partonomy},
+                    {'output_dir': output_dir, 'external_nodes': args.external_node_data},
+                    [get_vega_config_path(filename, only_female, only_male, output_dir)
+                     for filename, only_female, only_male, scenegraph, show_labels in VEGA_CONFIGS.values()]
+                    + ([f'{output_dir}/{VEGA_NODES_FILE}'] if args.external_node_data else []),
+                    after=[get_file_hash('./data/vega_config.json')])
+
+    wings = ['female', 'male']
+    rendered = stage('vega_render', render_vega, {'configs': configs},
+                     {'output_dir': output_dir, 'cache_dir': args.vega_cache_dir, 'workers': args.render_workers},
+                     [f'{output_dir}/vega_{wing}_viz.svg' for wing in wings])
+
+    coordinates = stage('node_coordinates', get_wing_coordinates, {'configs': configs})
+    if args.check_layout:
+        renderer = VegaRenderer(args.vega_cache_dir or None, args.render_workers)
+        check_layout_parity(configs[1], coordinates[1], output_dir=output_dir, renderer=renderer)
+        print(renderer.report())
+
+    blood = stage('blood_network', load_blood_network, {
+        'partonomy': partonomy,
+        'blood_edges_url': (get_table_hash(blood_edges_path), blood_edges_path),
+    })
+
+    # the wings only share the results above, each worker gets them pickled instead of reading the tables again
+    if args.wing_workers > 1:
+        with ProcessPoolExecutor(min(args.wing_workers, len(wings))) as pool:
+            futures = [pool.submit(run_wing, wing, (coordinates[0], coordinates[1][wing]), blood, rendered[0], args, output_dir)
+                       for wing in wings]
+            summary = [future.result() for future in futures]
+    else:
+        summary = [run_wing(wing, (coordinates[0], coordinates[1][wing]), blood, rendered[0], args, output_dir) for wing in wings]
 
+    failed = [wing_summary for wing_summary in summary if wing_summary['error']]
+    for wing_summary in summary:
+        status = 'failed' if wing_summary['error'] else 'done'
+        print(f"{wing_summary['wing']} wing: {status} in {wing_summary['seconds']:.1f}s")
+    for wing_summary in failed:
+        print(f"{wing_summary['wing']} wing error:\n{wing_summary['error']}")
+    if failed:
+        raise SystemExit(1)
 
-template = st.fromfile(f'{OUTPUT_DIR}/vega_male_viz.svg')
-template.set_size(size=('1720', '1720'))
-second_svg = st.fromfile(f'{OUTPUT_DIR}/blood_viz_male_bundled.svg')
-second_svg.set_size(size=('1720', '1720'))
 
-template.append(second_svg)
-template.save(f'{OUTPUT_DIR}/male_butterfly_wing.svg')
+if __name__ == "__main__":
+    main()
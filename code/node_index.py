@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+
+class NodeIndex:
+    '''
+    Lookups into the nodes table, built once so that a query does not scan the whole table.
+
+    Attributes:
+    nodes: pd.DataFrame
+        The nodes table, with the 'id', 'name' and 'ontology_id' columns.
+    name_rows: dict
+        The positions of the rows of every case-folded name, in table order.
+    ontology_id_rows: dict
+        The positions of the rows of every ontology ID, in table order.
+    graph_int_ids: pd.Series
+        The integer ID of every node ID, once it is set with `set_graph_int_ids`.
+    '''
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        rows = pd.Series(np.arange(len(nodes)))
+        self.name_rows = rows.groupby(nodes['name'].str.casefold().to_numpy(), sort=False).indices
+        self.ontology_id_rows = rows.groupby(nodes['ontology_id'].to_numpy(), sort=False).indices
+        self.graph_int_ids = None
+
+    def set_graph_int_ids(self, id_to_graph_int_id):
+        '''Set the integer IDs from a dictionary from node ID to integer ID.'''
+        self.graph_int_ids = pd.Series(id_to_graph_int_id)
+
+    def get_nodes(self, name=None, ontology_id=None):
+        '''The nodes with the name (case-insensitive) or the ontology ID.'''
+        if name:
+            return self.nodes.iloc[self.name_rows.get(name.casefold(), [])]
+        if ontology_id:
+            return self.nodes.iloc[self.ontology_id_rows.get(ontology_id, [])]
+
+    def find(self, names=None, ontology_ids=None):
+        '''
+        The nodes with any of the names (case-insensitive) or ontology IDs, grouped by key in the order of the keys.
+        The key that matched every row is in the 'key' column, keys without nodes have no rows.
+        '''
+        if names is not None:
+            keys, rows = list(names), [self.name_rows.get(name.casefold()) for name in names]
+        else:
+            keys, rows = list(ontology_ids), [self.ontology_id_rows.get(ontology_id) for ontology_id in ontology_ids]
+
+        rows = [positions if positions is not None else np.array([], dtype=int) for positions in rows]
+        positions = np.concatenate(rows) if rows else np.array([], dtype=int)
+        return self.nodes.iloc[positions].assign(key=np.repeat(np.array(keys, dtype=object), [len(r) for r in rows]))
+
+    def get_graph_int_ids(self, ids):
+        '''The integer IDs of the node IDs, NaN for unknown IDs.'''
+        return self.graph_int_ids.reindex(ids).to_numpy()
@@ -0,0 +1,272 @@
+import math
+
+import numpy as np
+
+
+class RadialLayout:
+    '''
+    The radial tree layout of `data/vega_config.json`, computed in process instead of by a Vega render.
+
+    The nodes are stratified by 'id' and 'parent' like Vega's stratify transform, children in table order,
+    and laid out by d3's tidy tree (Buchheim et al.) or cluster (dendrogram) layout with size [1, radius].
+    The text marks are placed at the same point as in the spec:
+
+        angle = (rotate + extent * alpha + 270) % 360
+        x = width / 2 + radius * cos(PI * angle / 180), y = height / 2 + radius * sin(PI * angle / 180)
+
+    The arithmetic follows d3 operation by operation, so the coordinates match the Vega scenegraph
+    up to the last bits of the cosine and sine.
+
+    Attributes:
+    ids: np.ndarray
+        The 'id' of every node, in table order.
+    parent: np.ndarray
+        The row of the parent of every node, -1 for the root.
+    child_ptr, children: np.ndarray
+        CSR child lists, the children of row i are children[child_ptr[i]:child_ptr[i+1]] in table order.
+    depth: np.ndarray
+        Distance from the root.
+    preorder: np.ndarray
+        The rows in depth-first preorder, children left to right.
+    '''
+
+    def __init__(self, ids, parent_ids):
+        self.ids = np.asarray(ids)
+        n = len(self.ids)
+        rows = {node_id: row for row, node_id in enumerate(self.ids.tolist())}
+        if len(rows) != n:
+            raise ValueError('Duplicate ids in the node table.')
+
+        parent = np.full(n, -1)
+        roots = []
+        for row, parent_id in enumerate(parent_ids):
+            if parent_id is None or (isinstance(parent_id, float) and math.isnan(parent_id)):
+                roots.append(row)
+            elif parent_id in rows:
+                parent[row] = rows[parent_id]
+            else:
+                raise ValueError(f'Missing parent id: {parent_id}')
+        if len(roots) != 1:
+            raise ValueError(f'Expected one root, found {len(roots)}.')
+        self.root = roots[0]
+        self.parent = parent
+
+        has_parent = np.flatnonzero(parent >= 0)
+        self.children = has_parent[np.argsort(parent[has_parent], kind='stable')]
+        self.child_ptr = np.concatenate([[0], np.cumsum(np.bincount(parent[has_parent], minlength=n))])
+
+        # preorder with an explicit stack, children pushed right to left
+        child_ptr, children = self.child_ptr.tolist(), self.children.tolist()
+        preorder, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            preorder.append(node)
+            stack.extend(reversed(children[child_ptr[node]:child_ptr[node + 1]]))
+        if len(preorder) != n:
+            raise ValueError('The node table has a cycle.')
+        self.preorder = np.array(preorder)
+
+        depth = np.zeros(n, dtype=int)
+        parent_list = parent.tolist()
+        for node in preorder[1:]:
+            depth[node] = depth[parent_list[node]] + 1
+        self.depth = depth
+
+    @classmethod
+    def from_config(cls, config):
+        '''Stratify the node table of a Vega config (config['data'][0]['values']).'''
+        values = config['data'][0]['values']
+        return cls([value['id'] for value in values], [value.get('parent') for value in values])
+
+    def tidy(self):
+        '''
+        d3.tree(): the x of every node before scaling, by the linear-time Buchheim walk.
+        Two neighbours are separated by 1 if they are siblings and by 2 otherwise.
+        '''
+        n = len(self.ids)
+        child_ptr, children, parent = self.child_ptr.tolist(), self.children.tolist(), self.parent.tolist()
+
+        # the rows of the tree nodes, with an extra node n above the root like d3's treeRoot
+        kids = [children[child_ptr[v]:child_ptr[v + 1]] for v in range(n)] + [[self.root]]
+        parent = parent + [-1]
+        parent[self.root] = n
+        position = [0] * (n + 1)
+        for v in range(n + 1):
+            for i, child in enumerate(kids[v]):
+                position[child] = i
+
+        z, m, c, s = [0.0] * (n + 1), [0.0] * (n + 1), [0.0] * (n + 1), [0.0] * (n + 1)
+        thread, ancestor, apportioned = [-1] * (n + 1), list(range(n + 1)), [-1] * (n + 1)
+
+        def separation(a, b):
+            return 1 if parent[a] == parent[b] else 2
+
+        def next_left(v):
+            return kids[v][0] if kids[v] else thread[v]
+
+        def next_right(v):
+            return kids[v][-1] if kids[v] else thread[v]
+
+        def move_subtree(wm, wp, shift):
+            change = shift / (position[wp] - position[wm])
+            c[wp] -= change
+            s[wp] += shift
+            c[wm] += change
+            z[wp] += shift
+            m[wp] += shift
+
+        def apportion(v, w, default_ancestor):
+            vip = vop = v
+            vim = w
+            vom = kids[parent[vip]][0]
+            sip, sop, sim, som = m[vip], m[vop], m[vim], m[vom]
+            while True:
+                vim, vip = next_right(vim), next_left(vip)
+                if vim < 0 or vip < 0:
+                    break
+                vom, vop = next_left(vom), next_right(vop)
+                ancestor[vop] = v
+                shift = z[vim] + sim - z[vip] - sip + separation(vim, vip)
+                if shift > 0:
+                    moved = ancestor[vim] if parent[ancestor[vim]] == parent[v] else default_ancestor
+                    move_subtree(moved, v, shift)
+                    sip += shift
+                    sop += shift
+                sim += m[vim]
+                sip += m[vip]
+                som += m[vom]
+                sop += m[vop]
+            if vim >= 0 and next_right(vop) < 0:
+                thread[vop] = vim
+                m[vop] += sim - sop
+            if vip >= 0 and next_left(vom) < 0:
+                thread[vom] = vip
+                m[vom] += sip - som
+                default_ancestor = v
+            return default_ancestor
+
+        # first walk in postorder, children left to right
+        for v in self._postorder():
+            siblings = kids[parent[v]]
+            w = siblings[position[v] - 1] if position[v] else -1
+            if kids[v]:
+                # execute the shifts of the children, right to left
+                shift = change = 0.0
+                for child in reversed(kids[v]):
+                    z[child] += shift
+                    m[child] += shift
+                    change += c[child]
+                    shift += s[child] + change
+                midpoint = (z[kids[v][0]] + z[kids[v][-1]]) / 2
+                if w >= 0:
+                    z[v] = z[w] + separation(v, w)
+                    m[v] = z[v] - midpoint
+                else:
+                    z[v] = midpoint
+            elif w >= 0:
+                z[v] = z[w] + separation(v, w)
+            if w >= 0:
+                start = apportioned[parent[v]] if apportioned[parent[v]] >= 0 else siblings[0]
+                apportioned[parent[v]] = apportion(v, w, start)
+            elif apportioned[parent[v]] < 0:
+                apportioned[parent[v]] = siblings[0]
+
+        # second walk in preorder
+        m[n] = -z[self.root]
+        x = [0.0] * n
+        for v in self.preorder.tolist():
+            x[v] = z[v] + m[parent[v]]
+            m[v] += m[parent[v]]
+        return np.array(x)
+
+    def _postorder(self):
+        '''The rows in depth-first postorder, children left to right.'''
+        child_ptr, children = self.child_ptr.tolist(), self.children.tolist()
+        order, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(children[child_ptr[node]:child_ptr[node + 1]])
+        return order[::-1]
+
+    def cluster(self):
+        '''
+        d3.cluster(): the x and y of every node before scaling. The leaves are placed one after the other in
+        postorder, an inner node is at the mean x of its children and one above the highest of them.
+        '''
+        n = len(self.ids)
+        leaves = self.preorder[self.child_ptr[self.preorder + 1] == self.child_ptr[self.preorder]]
+        x, y = np.zeros(n), np.zeros(n)
+        steps = np.where(self.parent[leaves[1:]] == self.parent[leaves[:-1]], 1.0, 2.0)
+        x[leaves[1:]] = np.cumsum(steps)
+
+        # inner nodes bottom-up, one depth at a time, summing the children in order like d3's reduce
+        inner = np.flatnonzero(self.child_ptr[1:] > self.child_ptr[:-1])
+        for d in range(self.depth.max() - 1, -1, -1):
+            level = inner[self.depth[inner] == d]
+            if len(level) == 0:
+                continue
+            counts = self.child_ptr[level + 1] - self.child_ptr[level]
+            starts = self.child_ptr[level]
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            kids, owners = self.children[offsets], np.repeat(level, counts)
+            sums, highest = np.zeros(n), np.zeros(n)
+            np.add.at(sums, owners, x[kids])
+            np.maximum.at(highest, owners, y[kids])
+            x[level] = sums[level] / counts
+            y[level] = 1 + highest[level]
+        return x, y
+
+    def layout(self, method='tidy', radius=1.0):
+        '''
+        The (alpha, radius) of every node, like Vega's tree transform with `size` [1, radius]:
+        alpha in [0, 1] along the circle and radius proportional to the depth (tidy) or height (cluster).
+        '''
+        if method == 'cluster':
+            x, y = self.cluster()
+            leaves = np.flatnonzero(self.child_ptr[self.preorder + 1] == self.child_ptr[self.preorder])
+            left, right = self.preorder[leaves[0]], self.preorder[leaves[-1]]
+            separation = 1 if self.parent[left] == self.parent[right] else 2
+            x0, x1 = x[left] - separation / 2, x[right] + separation / 2
+            root_y = y[self.root]
+            alpha = (x - x0) / (x1 - x0) * 1
+            return alpha, (1 - (y / root_y if root_y else 1)) * radius
+
+        if method != 'tidy':
+            raise ValueError(f'Unknown layout method: {method}')
+        x = self.tidy()
+        # the extremes are the first nodes in preorder with the smallest and largest x and the largest depth
+        ordered = x[self.preorder]
+        left, right = self.preorder[np.argmin(ordered)], self.preorder[np.argmax(ordered)]
+        bottom = self.preorder[np.argmax(self.depth[self.preorder])]
+        s = 1 if left == right else (1 if self.parent[left] == self.parent[right] else 2) / 2
+        tx = s - x[left]
+        kx = 1 / (x[right] + s + tx)
+        ky = radius / (self.depth[bottom] or 1)
+        return (x + tx) * kx, self.depth * ky
+
+    def coordinates(self, width, height, radius, extent=360, rotate=0, method='tidy'):
+        '''
+        The (x, y) of the text mark of every node, keyed by 'id', the same dictionary as `get_node_coordinates`
+        gets from a Vega scenegraph.
+        '''
+        alpha, r = self.layout(method, radius)
+        angle = np.fmod(rotate + extent * alpha + 270, 360)
+        radians = np.pi * angle / 180
+        x = [width / 2 + d * math.cos(a) for d, a in zip(r.tolist(), radians.tolist())]
+        y = [height / 2 + d * math.sin(a) for d, a in zip(r.tolist(), radians.tolist())]
+        return dict(zip(self.ids.tolist(), zip(x, y)))
+
+
+def get_signal(config, name):
+    return next(signal['value'] for signal in config['signals'] if signal['name'] == name)
+
+
+def get_layout_coordinates(config):
+    '''
+    The coordinates of the nodes of a Vega config made by `create_vega_configs`, computed with the
+    `radius`, `extent`, `rotate` and `layout` signals and the size of the config, without rendering it.
+    '''
+    return RadialLayout.from_config(config).coordinates(
+        config['width'], config['height'], get_signal(config, 'radius'), extent=get_signal(config, 'extent'),
+        rotate=get_signal(config, 'rotate'), method=get_signal(config, 'layout'))
@@ -0,0 +1,107 @@
+import numpy as np
+
+
+def simplify_polylines(points, first, last, tolerance):
+    '''
+    Douglas-Peucker simplification of the polylines points[first[i]:last[i]+1], all of them at once.
+
+    The ends of every polyline are kept; a stretch between two kept points is split at its point furthest from
+    the chord until no point is more than `tolerance` from it. The stretches of all the polylines are split
+    together, one level at a time.
+
+    Returns a boolean mask of the points to keep.
+    '''
+    keep = np.zeros(len(points), dtype=bool)
+    keep[first] = True
+    keep[last] = True
+
+    lo, hi = first[last - first > 1], last[last - first > 1]
+    while len(lo):
+        counts = hi - lo - 1
+        offsets = np.repeat(lo + 1 - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        stretch = np.repeat(np.arange(len(lo)), counts)
+
+        # distance to the chord, or to its start if the chord has no length
+        start, chord = points[lo][stretch], (points[hi] - points[lo])[stretch]
+        relative = points[offsets] - start
+        length = np.hypot(chord[:, 0], chord[:, 1])
+        cross = np.abs(chord[:, 0] * relative[:, 1] - chord[:, 1] * relative[:, 0])
+        distance = np.where(length > 0, cross / np.where(length > 0, length, 1), np.hypot(relative[:, 0], relative[:, 1]))
+
+        # the furthest point of every stretch: the first one after sorting by stretch and decreasing distance
+        order = np.lexsort((-distance, stretch))
+        group_start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        furthest = order[group_start]
+        split = distance[furthest] > tolerance
+
+        middle = offsets[furthest[split]]
+        keep[middle] = True
+        lo, hi = np.concatenate([lo[split], middle]), np.concatenate([middle, hi[split]])
+        narrow = hi - lo > 1
+        lo, hi = lo[narrow], hi[narrow]
+
+    return keep
+
+
+def format_path(points, precision=2, tolerance=0):
+    '''
+    The SVG path data of the NaN-separated polylines in `points` (an (n, 2) array like the 'x' and 'y' columns
+    of a `hammer_bundle` result): every polyline is a moveto followed by implicit linetos, the coordinates are
+    rounded to `precision` decimals and repeated points are left out. With a `tolerance` > 0 the polylines are
+    simplified first, no left out point is further than `tolerance` from the path.
+    '''
+    points = np.asarray(points, dtype=float)
+    gap = np.isnan(points).any(axis=1)
+    # a polyline starts at the first point and at every point after a gap, and ends before a gap or at the end
+    starts = ~gap & np.concatenate([[True], gap[:-1]])
+    ends = ~gap & np.concatenate([gap[1:], [True]])
+
+    keep = ~gap
+    if tolerance > 0:
+        keep &= simplify_polylines(points, np.flatnonzero(starts), np.flatnonzero(ends), tolerance)
+    points, starts = points[keep], starts[keep]
+
+    # + 0.0 turns -0.0 into 0.0
+    rounded = np.round(points, precision) + 0.0
+    # a point at the same place as the one before it in the same polyline draws nothing
+    repeated = np.concatenate([[False], (rounded[1:] == rounded[:-1]).all(axis=1)]) & ~starts
+    rounded, starts = rounded[~repeated], starts[~repeated]
+    if len(rounded) == 0:
+        return ''
+
+    coordinates = np.char.mod(f'%.{precision}f', rounded)
+    if precision > 0:
+        # 12.50 -> 12.5, 3.00 -> 3
+        coordinates = np.char.rstrip(np.char.rstrip(coordinates, '0'), '.')
+    pairs = np.char.add(np.char.add(coordinates[:, 0], ','), coordinates[:, 1])
+    commands = np.where(starts, 'M', ' ')
+    return ''.join(np.char.add(commands, pairs).tolist())
+
+
+def write_svg_paths(path, layers, size=1720, width='1238.4pt', precision=2, tolerance=0):
+    '''
+    Write an SVG of `size` x `size` user units (the canvas of the Vega visualization) with one <path> per layer,
+    the points are in canvas coordinates with y growing downwards.
+
+    Parameters:
+    path: str
+        The file to write.
+    layers: list
+        (points, stroke color, stroke opacity, stroke width) of every path, drawn in order. The stroke width is in
+        canvas units.
+    size: float
+        The width and height of the canvas (the viewBox).
+    width: str
+        The width and height of the SVG document.
+    precision: int
+        The number of decimals of the coordinates.
+    tolerance: float
+        How far (in canvas units) a point left out by the simplification of `format_path` can be from the path.
+    '''
+    paths = [f'<path d="{format_path(points, precision, tolerance)}" style="fill:none;stroke:{color};stroke-opacity:{opacity};'
+             f'stroke-width:{stroke_width:g};stroke-linecap:square;stroke-linejoin:round"/>'
+             for points, color, opacity, stroke_width in layers]
+    with open(path, 'w') as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{width}" height="{width}" viewBox="0 0 {size} {size}">\n')
+        f.write('\n'.join(paths))
+        f.write('\n</svg>\n')
@@ -0,0 +1,40 @@
+'''
+Time `build_tree` against the successor scan it replaced on a synthetic release with a wide fan-out.
+
+    python tests/benchmark_build_tree.py [--children 4000] [--rows 20000]
+
+Both merges get the same paths and must build the same tree.
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from test_build_network import build_network, build_tree_by_scan, get_release_paths, wide_release
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--children', type=int, default=4000, help='structures under the root of every organ')
+    parser.add_argument('--rows', type=int, default=20000, help='rows of every organ table')
+    args = parser.parse_args()
+
+    release = wide_release(args.children, args.rows)
+    timings = {}
+    trees = {}
+    for name, merge in [('child index', build_network.build_tree), ('successor scan', build_tree_by_scan)]:
+        paths = get_release_paths(release)
+        start = time.perf_counter()
+        trees[name] = merge(paths)
+        timings[name] = time.perf_counter() - start
+
+    (tree, dup), (expected_tree, expected_dup) = trees.values()
+    assert dup == expected_dup and list(tree.edges(data=True)) == list(expected_tree.edges(data=True))
+    print(f'{tree.number_of_nodes()} nodes, {dup} duplicated, {args.children} children per organ root')
+    for name, seconds in timings.items():
+        print(f'{name}: {seconds:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
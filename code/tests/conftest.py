@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts are run from code/ and import the modules next to them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
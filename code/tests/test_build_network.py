@@ -0,0 +1,243 @@
+import glob
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+spec = importlib.util.spec_from_file_location('build_network', os.path.join(os.path.dirname(__file__), '..', 'build-network.py'))
+build_network = importlib.util.module_from_spec(spec)
+sys.modules['build_network'] = build_network
+spec.loader.exec_module(build_network)
+
+
+class ReleaseHandler(BaseHTTPRequestHandler):
+    '''Serves `server.release` with an ETag, answers a matching If-None-Match with 304 and fails on request.'''
+
+    def do_GET(self):
+        server = self.server
+        if server.status >= 500:
+            self.send_error(server.status)
+        elif self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', str(len(server.release)))
+            self.end_headers()
+            # a truncated download stops half way through the announced length
+            self.wfile.write(server.release[:len(server.release) // 2] if server.truncate else server.release)
+        server.responses.append(self.headers.get('If-None-Match') and server.etag)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ReleaseHandler)
+    httpd.status, httpd.truncate, httpd.responses = 200, False, []
+    httpd.release, httpd.etag = json.dumps({'heart': []}).encode(), '"v1"'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/hra-asctb-all.v2.2.json'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_release_downloads_and_revalidates(server, tmp_path):
+    cache_dir = str(tmp_path)
+    path = build_network.fetch_release(server.url, cache_dir)
+    assert read(path) == server.release
+
+    # unchanged: a conditional request answered with 304
+    assert build_network.fetch_release(server.url, cache_dir) == path
+    assert server.responses == [None, '"v1"']
+
+    # changed: downloaded again and the old copy removed
+    server.release, server.etag = json.dumps({'heart': [], 'kidney': []}).encode(), '"v2"'
+    new_path = build_network.fetch_release(server.url, cache_dir)
+    assert new_path != path and read(new_path) == server.release
+    assert not os.path.exists(path)
+
+
+def test_fetch_release_offline(server, tmp_path):
+    cache_dir = str(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        build_network.fetch_release(server.url, cache_dir, offline=True)
+
+    path = build_network.fetch_release(server.url, cache_dir)
+    assert build_network.fetch_release(server.url, cache_dir, offline=True) == path
+    assert len(server.responses) == 1
+
+
+def test_fetch_release_falls_back_to_the_cache_on_server_error(server, tmp_path):
+    cache_dir = str(tmp_path)
+    server.status = 503
+    with pytest.raises(requests.HTTPError):
+        build_network.fetch_release(server.url, cache_dir)
+
+    server.status = 200
+    path = build_network.fetch_release(server.url, cache_dir)
+    server.status = 503
+    assert build_network.fetch_release(server.url, cache_dir) == path
+
+
+def test_fetch_release_falls_back_to_the_cache_when_unreachable(server, tmp_path):
+    cache_dir = str(tmp_path)
+    with pytest.raises(requests.ConnectionError):
+        build_network.fetch_release(f'http://127.0.0.1:{free_port()}/hra-asctb-all.v2.2.json', cache_dir)
+
+    path = build_network.fetch_release(server.url, cache_dir)
+    server.shutdown()
+    server.server_close()
+    assert build_network.fetch_release(server.url, cache_dir) == path
+
+
+def test_fetch_release_removes_interrupted_download(server, tmp_path):
+    server.truncate = True
+    with pytest.raises(requests.RequestException):
+        build_network.fetch_release(server.url, str(tmp_path))
+    assert glob.glob(str(tmp_path / '*.part')) == []
+    assert build_network.load_cache_index(str(tmp_path)) == {}
+
+
+def free_port():
+    with ThreadingHTTPServer(('127.0.0.1', 0), BaseHTTPRequestHandler) as httpd:
+        return httpd.server_address[1]
+
+
+def item(ontology_id, name):
+    return {'id': ontology_id, 'name': name, 'rdfs_label': ''}
+
+
+def wide_release(children=200, rows=1000, seed=0):
+    '''
+    A synthetic release whose organs each hang `children` structures directly under their root, a wide fan-out,
+    with structures shared between organs (duplicated in the tree), structures without an id and cell types.
+    '''
+    rng = random.Random(seed)
+    release = {}
+    for table in ['blood-vasculature', 'kidney', 'liver', 'skeleton']:
+        root = item('UBERON:0000948', 'heart') if table == 'blood-vasculature' else item(f'UBERON:{table}', table)
+        data = []
+        for row in range(rows):
+            child = rng.randrange(children)
+            path = [root, item(f'UBERON:1{child:06d}', f'structure {child}')]
+            if rng.random() < 0.5:
+                path.append(item(f'UBERON:2{rng.randrange(50):06d}', 'shared structure'))
+            if rng.random() < 0.1:
+                path.append(item(' ', f'Temp Structure {child}'))
+            cell_types = [item(f'CL:{rng.randrange(30):07d}', 'cell') for _ in range(rng.randrange(3))]
+            data.append({'anatomical_structures': path, 'cell_types': cell_types, 'biomarkers_gene': [], 'references': []})
+        release[table] = {'data': data}
+    return release
+
+
+def get_release_paths(release):
+    '''The paths of the included tables in `get_tables` order, made fresh: `build_tree` renames their items.'''
+    tables = [table for table in release if build_network.is_included(table)]
+    return [path for table in build_network.get_tables(tables) for path in build_network.get_table_paths(table, release[table])]
+
+
+def build_tree_by_scan(paths):
+    '''The merge loop `build_tree` replaces: an existing child is found by scanning all successors of the parent.'''
+    tree = build_network.nx.DiGraph()
+    build_network.add_node(tree, build_network.BODY)
+    dup = 0
+    for path in paths:
+        as_path = path['as'] + path['ct'] if build_network.INCLUDE_CELL_TYPES else path['as']
+        if not tree.has_node(as_path[0].id):
+            build_network.add_node(tree, as_path[0])
+            build_network.add_edge(tree, build_network.BODY, as_path[0])
+
+        for src in range(len(as_path) - 1):
+            source, target = as_path[src], as_path[src + 1]
+            if source.id != target.id and not tree.has_edge(source.id, target.id):
+                if not tree.has_node(source.id):
+                    build_network.add_node(tree, source)
+                else:
+                    found_child = None
+                    for child in tree.successors(source.id):
+                        if tree.nodes[child]['ontology_id'] == target.ontology_id:
+                            target.id = child
+                            found_child = True
+                    if not found_child and tree.has_node(target.id):
+                        dup += 1
+                        target.id = f'{target.id}$${dup}'
+                if not tree.has_node(target.id):
+                    build_network.add_node(tree, target)
+                build_network.add_edge(tree, source, target)
+    return tree, dup
+
+
+def test_build_tree_matches_successor_scan():
+    release = wide_release()
+    tree, dup = build_network.build_tree(get_release_paths(release))
+    expected_tree, expected_dup = build_tree_by_scan(get_release_paths(release))
+
+    assert dup == expected_dup > 0
+    assert list(tree.nodes(data=True)) == list(expected_tree.nodes(data=True))
+    assert list(tree.edges(data=True)) == list(expected_tree.edges(data=True))
+
+
+def build_args(tmp_path, **options):
+    args = dict(
+        parquet=False, max_render_nodes=10000, incremental=True, exports=['graphml'], cache_dir=str(tmp_path / 'cache'),
+        stream=False, workers=1, export_timeout=60,
+    )
+    args.update(options)
+    return build_network.argparse.Namespace(**args)
+
+
+def write_export(graph, exports, stem):
+    '''Stands in for `export_graph`, which needs graphviz for the dot and svg exports.'''
+    for export in exports:
+        with open(f'{stem}.{export}', 'w') as f:
+            f.write(export)
+
+
+def failing_export(graph, exports, stem):
+    raise RuntimeError('export failed')
+
+
+def test_incremental_build_reruns_missing_and_failed_exports(tmp_path, monkeypatch):
+    release_path = tmp_path / 'hra-asctb-all.v2.2.json'
+    release_path.write_text(json.dumps(wide_release(children=20, rows=50)))
+    output_dir = str(tmp_path / 'out')
+
+    def build(**options):
+        return build_network.build('v2.2', str(release_path), build_args(tmp_path, **options), output_dir)
+
+    monkeypatch.setattr(build_network, 'export_graph', failing_export)
+    assert build()['failed_exports'] == ['asct-tree']
+    assert build_network.load_manifest(output_dir)['exports'] == {'graphml': 'failed'}
+
+    # the failed export is retried, then the build is up to date
+    monkeypatch.setattr(build_network, 'export_graph', write_export)
+    assert not build()['skipped']
+    assert build_network.load_manifest(output_dir)['exports'] == {'graphml': 'done'}
+    assert build()['skipped']
+
+    # a newly selected export, or a deleted one, is not up to date
+    assert not build(exports=['graphml', 'dot'])['skipped']
+    os.remove(os.path.join(output_dir, 'asct-tree.dot'))
+    assert not build(exports=['graphml', 'dot'])['skipped']
+    assert build(exports=['graphml', 'dot'])['skipped']
+
+    # an svg not rendered because of the size of the graph does not hold the build up
+    assert not build(exports=['graphml', 'svg', 'blood-svg'], max_render_nodes=1)['skipped']
+    assert build_network.load_manifest(output_dir)['exports'] == {'graphml': 'done', 'svg': 'skipped', 'blood-svg': 'skipped'}
+    assert build(exports=['graphml', 'svg', 'blood-svg'], max_render_nodes=1)['skipped']
@@ -0,0 +1,47 @@
+import random
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact_tree import CompactTree
+
+
+def random_edges(n, seed):
+    '''The edges of a random tree on `n` nodes, shuffled, in random directions and with a few repeated.'''
+    rng = random.Random(seed)
+    edges = list(nx.random_tree(n, seed=seed).edges) if hasattr(nx, 'random_tree') else list(nx.random_labeled_tree(n, seed=seed).edges)
+    rng.shuffle(edges)
+    edges = [(b, a) if rng.random() < 0.5 else (a, b) for a, b in edges] + edges[:3]
+    return pd.DataFrame([(f'n{a}', f'n{b}') for a, b in edges], columns=['source', 'target'])
+
+
+def test_compact_tree_matches_networkx():
+    rng = random.Random(0)
+    for trial in range(20):
+        edges = random_edges(rng.randint(2, 200), seed=trial)
+        graph = nx.from_pandas_edgelist(edges, 'source', 'target')
+        root = edges['source'].iloc[0]
+        tree = CompactTree.from_edges(edges['source'], edges['target'], root)
+        oriented = nx.bfs_tree(graph, root)
+
+        assert tree.is_tree()
+        assert tree.bfs_predecessors() == dict(nx.bfs_predecessors(graph, root))
+        assert list(tree.depths().items()) == list(nx.single_source_shortest_path_length(graph, root).items())
+        assert list(tree.dfs_preorder()) == list(nx.dfs_preorder_nodes(graph, root))
+
+        labels = rng.sample(list(graph), min(4, len(graph)))
+        expected = set(labels).union(*(nx.ancestors(oriented, label) for label in labels))
+        assert set(tree.ids[tree.ancestors(labels)]) == expected
+
+        for label in labels:
+            assert list(tree.dfs_preorder(label)) == list(nx.dfs_preorder_nodes(oriented, label))
+        expected = [node for label in labels for node in nx.dfs_preorder_nodes(oriented, label)]
+        assert list(tree.ids[tree.subtrees(labels)]) == expected
+
+
+def test_compact_tree_rejects_missing_labels():
+    edges = pd.DataFrame({'source': ['a', 'a', np.nan], 'target': ['b', 'c', 'd']})
+    with pytest.raises(ValueError, match='1 missing sources'):
+        CompactTree.from_edges(edges['source'], edges['target'], 'a')
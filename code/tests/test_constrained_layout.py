@@ -0,0 +1,36 @@
+import networkx as nx
+import numpy as np
+
+from constrained_layout import constrained_spring_layout
+
+
+def test_constrained_spring_layout_matches_networkx():
+    rng = np.random.default_rng(0)
+    for trial in range(20):
+        graph = nx.gnm_random_graph(int(rng.integers(5, 60)), int(rng.integers(5, 120)), seed=trial)
+        graph.add_edge(0, 0)
+        nodes = list(graph)
+        fixed = [node for node in nodes if rng.random() < 0.7]
+        pos = {node: rng.random(2) * 1720 for node in fixed}
+        k = 0.01 / np.sqrt(len(graph))
+
+        expected = nx.spring_layout(graph, pos=pos, fixed=fixed or None, k=k, iterations=50, seed=trial)
+        positions, stats = constrained_spring_layout(graph, pos, fixed, k, iterations=50, seed=trial)
+
+        assert stats['free_nodes'] == len(nodes) - len(fixed)
+        for node in nodes:
+            np.testing.assert_array_equal(positions[node], expected[node])
+
+
+def test_constrained_spring_layout_stops_early():
+    # one free node pulled by two pinned ends, it settles half way between them
+    graph = nx.Graph([(0, 'free'), ('free', 1)])
+    pos = {0: (0.0, 0.0), 1: (100.0, 0.0)}
+
+    positions, stats = constrained_spring_layout(graph, pos, [0, 1], k=1.0, iterations=1000, seed=0)
+    assert stats['iterations'] == 1000
+
+    positions, stats = constrained_spring_layout(graph, pos, [0, 1], k=1.0, iterations=1000, seed=0, tolerance=0.1)
+    assert stats['iterations'] < 1000
+    assert stats['displacement'] < 0.1
+    np.testing.assert_allclose(positions['free'], (50.0, 0.0), atol=0.1)
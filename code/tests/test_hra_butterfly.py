@@ -0,0 +1,188 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from compact_tree import CompactTree
+from hra_butterfly import classify_arteries_and_veins, get_coordinates_for_blood_nodes, get_heart_chambers, get_removable_blood_nodes
+
+
+def get_removable_blood_nodes_by_removal(edges, blood_nodes_candidates):
+    '''The pruning loop `get_removable_blood_nodes` replaces: remove the candidates one by one, farthest from the
+    body first, and check the connectivity of the whole graph after each removal.'''
+    graph = nx.from_pandas_edgelist(edges, source='source_int', target='target_int', edge_attr=True)
+    distance_from_body = nx.single_source_shortest_path_length(graph, source=0)
+    distance_from_body_blood_nodes = {k: v for k, v in distance_from_body.items() if k in blood_nodes_candidates}
+    node_visiting_order = sorted(distance_from_body_blood_nodes.items(), key=lambda x: x[1], reverse=True)
+
+    removable = set()
+    for node, distance in node_visiting_order:
+        graph.remove_node(node)
+        if nx.is_connected(graph):
+            removable.add(node)
+        else:
+            break
+    return removable
+
+
+def random_partonomy(rng, n, extra_edges=0):
+    '''A random tree on 0..n-1 rooted at 0 (the body), with `extra_edges` random edges on top.'''
+    sources = [int(rng.integers(0, i)) for i in range(1, n)] + rng.integers(0, n, extra_edges).tolist()
+    targets = list(range(1, n)) + rng.integers(0, n, extra_edges).tolist()
+    edges = pd.DataFrame({'source_int': sources, 'target_int': targets, 'organ': 'blood_vasculature'})
+    return edges[edges['source_int'] != edges['target_int']]
+
+
+def random_candidates(rng, n, with_root=False):
+    p = rng.random()
+    candidates = {node for node in range(1, n) if rng.random() < p}
+    if with_root:
+        # the body itself is a candidate, one other node is not so the graph never runs empty
+        candidates = (candidates | {0}) - {n - 1}
+    return candidates
+
+
+@pytest.mark.parametrize('extra_edges', [0, 1, 4])
+def test_removable_blood_nodes_match_removal_loop(extra_edges):
+    rng = np.random.default_rng(extra_edges)
+    for trial in range(100):
+        n = int(rng.integers(2, 120))
+        edges = random_partonomy(rng, n, extra_edges)
+        candidates = random_candidates(rng, n)
+        if trial % 10 == 0:
+            # candidates that are not in the partonomy are never removed
+            candidates.add(10**6)
+        assert get_removable_blood_nodes(edges, candidates) == get_removable_blood_nodes_by_removal(edges, candidates)
+
+
+def test_removable_blood_nodes_with_candidate_root():
+    rng = np.random.default_rng(1)
+    for trial in range(100):
+        n = int(rng.integers(3, 120))
+        edges = random_partonomy(rng, n, extra_edges=trial % 3)
+        candidates = random_candidates(rng, n, with_root=True)
+        assert get_removable_blood_nodes(edges, candidates) == get_removable_blood_nodes_by_removal(edges, candidates)
+
+
+def test_removable_blood_nodes_stop_at_first_branch():
+    # 0 - 1 - 2 - 3 and 1 - 4, the candidates 2 and 3 are a removable branch, 1 still holds the organ 4
+    edges = pd.DataFrame({'source_int': [0, 1, 2, 1], 'target_int': [1, 2, 3, 4]})
+    assert get_removable_blood_nodes(edges, {1, 2, 3}) == {2, 3}
+    assert get_removable_blood_nodes(edges, {1, 2, 3, 4}) == {1, 2, 3, 4}
+
+
+def test_removable_blood_nodes_on_large_tree():
+    # too large for the removal loop: check that the result is a prefix of its visiting order that keeps the graph
+    # connected and that removing the next node would not
+    rng = np.random.default_rng(0)
+    n = 100_000
+    edges = pd.DataFrame({'source_int': (rng.random(n - 1) * np.arange(1, n)).astype(int), 'target_int': np.arange(1, n)})
+    graph = nx.from_pandas_edgelist(edges, source='source_int', target='target_int')
+    # whole blood subtrees, removed first, and blood nodes close to the body that hold other organs
+    body_tree = nx.bfs_tree(graph, 0)
+    candidates = set()
+    for root in rng.choice(np.arange(1, n), size=n // 2000, replace=False).tolist():
+        candidates |= nx.descendants(body_tree, root) | {root}
+    distance_from_body = nx.single_source_shortest_path_length(graph, source=0)
+    candidates |= {node for node, d in distance_from_body.items() if 0 < d <= 2}
+
+    removable = get_removable_blood_nodes(edges, candidates)
+
+    order = [node for node, d in sorted(distance_from_body.items(), key=lambda x: x[1], reverse=True) if node in candidates]
+    assert removable == set(order[:len(removable)])
+    assert len(removable) < len(order)
+    graph.remove_nodes_from(removable)
+    assert nx.is_connected(graph)
+    graph.remove_node(order[len(removable)])
+    assert not nx.is_connected(graph)
+
+
+def classify_arteries_and_veins_by_left_side(blood_graph, heart, left_side):
+    '''The rule `classify_arteries_and_veins` replaces: a node is an artery if its component without the heart
+    has a node of the left side of the heart, and a vein otherwise.'''
+    components = blood_graph.copy()
+    components.remove_node(heart)
+    components = list(nx.connected_components(components)) + [{heart}]
+    return {node: 'artery' if set(left_side + [heart]) & next(c for c in components if node in c) else 'vein'
+            for node in blood_graph}
+
+
+def four_component_blood_graph():
+    '''
+    A heart (0) with four components around it and two that are not connected to it:
+    1 - 2 with the left side (2), 3 - 4 with the right side (4), 5 - 6 - 7 with both sides (6 left, 7 right),
+    8 - 9 with neither, and 10 - 11 and 12 without the heart.
+    '''
+    blood_graph = nx.Graph([(0, 1), (1, 2), (0, 3), (3, 4), (0, 5), (5, 6), (6, 7), (0, 8), (8, 9), (10, 11)])
+    blood_graph.add_node(12)
+    return blood_graph, 0, [2, 6], [4, 7]
+
+
+def test_classify_arteries_and_veins():
+    assert classify_arteries_and_veins(*four_component_blood_graph()) == {
+        0: 'artery', 1: 'artery', 2: 'artery', 3: 'vein', 4: 'vein',
+        5: 'ambiguous', 6: 'ambiguous', 7: 'ambiguous', 8: 'ambiguous', 9: 'ambiguous',
+        10: 'unreached', 11: 'unreached', 12: 'unreached',
+    }
+
+
+def test_classify_arteries_and_veins_against_left_side_rule():
+    # the components with one side of the heart are labelled as before; the old rule called a component with both
+    # sides an artery and one with neither side, or without the heart, a vein, so these nodes were in the veins
+    blood_graph, heart, left_side, right_side = four_component_blood_graph()
+    labels = classify_arteries_and_veins(blood_graph, heart, left_side, right_side)
+    old_labels = classify_arteries_and_veins_by_left_side(blood_graph, heart, left_side)
+
+    assert {node for node, label in labels.items() if label != old_labels[node]} == set(range(5, 13))
+    assert all(old_labels[node] == 'artery' for node in [5, 6, 7])
+    assert all(old_labels[node] == 'vein' for node in range(8, 13))
+
+
+def blood_fixture():
+    '''
+    A heart (0) with the left side 1 - 2 - 3 - 4 (left ventricle, aorta, renal artery, prostatic artery) and the
+    right side 5 - 6 - 7 (right cardiac atrium, vena cava, renal vein). The renal vessels and the prostatic artery
+    are also partonomy nodes; the aorta (2) and the vena cava (6) have no Vega coordinates.
+    '''
+    names = ['heart', 'Left Ventricle', 'aorta', 'renal artery', 'prostatic artery', 'right cardiac atrium', 'vena cava',
+             'renal vein', np.nan]
+    blood_nodes = pd.DataFrame({
+        'id': [f'UBERON:{i}' for i in range(9)], 'name': names, 'graph_int_id': range(9),
+        'artery/vein': ['artery'] * 5 + ['vein'] * 3 + ['unreached'],
+    })
+    blood_edges = pd.DataFrame({'source_int': [0, 1, 2, 3, 0, 5, 6], 'target_int': [1, 2, 3, 4, 5, 6, 7]})
+    blood = {
+        'blood_nodes': blood_nodes,
+        'blood_graph_int': nx.from_pandas_edgelist(blood_edges, source='source_int', target='target_int'),
+        'blood_tree': CompactTree.from_edges(blood_edges['source_int'], blood_edges['target_int'], root=0),
+        'id_of_heart': 0,
+        'matching_nodes': pd.DataFrame({'graph_int_id': [3, 4, 7], 'organ': ['kidney', 'prostate', 'kidney']}),
+    }
+    coordinates = {node: (10.0 * node, 100.0 - node) for node in [0, 1, 3, 4, 5, 7]}
+    return blood, coordinates
+
+
+def test_heart_chambers_match_row_lookup():
+    blood, coordinates = blood_fixture()
+    blood_nodes = blood['blood_nodes']
+    # the per-row lookups `get_heart_chambers` replaces
+    left = blood_nodes[blood_nodes['name'].apply(lambda x: 'left cardiac atrium' in str(x).lower() or 'left ventricle' in str(x).lower())]
+    right = blood_nodes[blood_nodes['name'].apply(lambda x: 'right cardiac atrium' in str(x).lower() or 'right ventricle' in str(x).lower())]
+
+    assert get_heart_chambers(blood_nodes) == (left['graph_int_id'].tolist(), right['graph_int_id'].tolist()) == ([1], [5])
+
+
+@pytest.mark.parametrize('wing', ['female', 'male'])
+def test_blood_node_coordinates_match_row_lookup(wing):
+    blood, coordinates = blood_fixture()
+    layout = get_coordinates_for_blood_nodes(blood, coordinates, only_female=wing == 'female', only_male=wing == 'male',
+                                             iterations=5)
+
+    # the per-row lookup `get_coordinates_for_blood_nodes` replaces: the nodes with coordinates are pinned to them
+    for vessels in ['veins', 'arteries']:
+        nodes = pd.Series(list(layout['graphs'][vessels]))
+        found = nodes[nodes.apply(lambda x: coordinates[x] if x in coordinates else np.nan).notna()]
+        for node in found:
+            np.testing.assert_array_equal(layout['pos'][vessels][node], coordinates[node])
+        assert layout['stats'][vessels]['free_nodes'] == len(nodes) - len(found) == 1
+    assert (4 in layout['graphs']['arteries']) == (wing == 'male')
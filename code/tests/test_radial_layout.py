@@ -0,0 +1,34 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from hra_butterfly import get_node_coordinates, get_vega_node_values, load_vega_template
+from radial_layout import get_layout_coordinates
+
+vlc = pytest.importorskip('vl_convert')
+
+
+def small_config(method, n=40, seed=0):
+    '''The Vega template with a random tree of `n` nodes and the `method` layout, the nodes named by their id.'''
+    rng = np.random.default_rng(seed)
+    node_table = pd.DataFrame({
+        'id': range(n), 'name': '', 'parent': [0] + [int(rng.integers(0, i)) for i in range(1, n)], 'type': 'AS',
+        'ontology_id': '', 'id_from_ontology_id': '', 'color': '#984ea0', 'organ': 'heart',
+    })
+    template = load_vega_template(os.path.join(os.path.dirname(__file__), '..', 'data', 'vega_config.json'))
+    config = {**template, 'data': [{**template['data'][0], 'values': get_vega_node_values(node_table, scenegraph=True)}] + template['data'][1:]}
+    config['signals'] = [{**signal, 'value': method} if signal['name'] == 'layout' else signal for signal in template['signals']]
+    return config
+
+
+@pytest.mark.parametrize('method', ['tidy', 'cluster'])
+def test_layout_coordinates_match_vega(method):
+    config = small_config(method)
+    expected = get_node_coordinates(vlc.vega_to_scenegraph(config))
+    coordinates = get_layout_coordinates(config)
+
+    assert coordinates.keys() == expected.keys()
+    for node, (x, y) in expected.items():
+        assert coordinates[node] == pytest.approx((x, y), abs=1e-9)
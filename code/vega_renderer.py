@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import vl_convert as vlc
+
+
+# the file extension of every output format, and the vl-convert function that renders it
+FORMATS = {
+    'svg': ('svg', vlc.vega_to_svg),
+    'scenegraph': ('json', vlc.vega_to_scenegraph),
+}
+
+
+class VegaRenderer:
+    '''
+    Renders batches of Vega specs with vl-convert and keeps the results in a disk cache.
+
+    A spec is serialized once to canonical JSON (sorted keys, no whitespace); its hash, the output format and the
+    vl-convert version are the cache key, and the same string is handed to vl-convert so the spec is not
+    serialized again. The specs that are not in the cache are rendered one after the other, or on a thread pool
+    with `workers` > 1.
+
+    Attributes:
+    cache_dir: str
+        Directory of the cached SVGs and scenegraphs, None to render without a cache.
+    workers: int
+        Number of threads rendering at the same time.
+    hits, misses: int
+        Counts since the renderer was created.
+    '''
+
+    def __init__(self, cache_dir=None, workers=1):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, spec_json, output_format):
+        h = hashlib.sha256()
+        h.update(f'{output_format}\0{vlc.__version__}\0'.encode())
+        h.update(spec_json.encode())
+        return os.path.join(self.cache_dir, f'{h.hexdigest()}.{FORMATS[output_format][0]}')
+
+    def render(self, jobs):
+        '''
+        Render the (spec, format) pairs of `jobs`, the format is 'svg' or 'scenegraph'.
+
+        Returns the results in the order of the jobs: the SVG string or the scenegraph dictionary.
+        '''
+        results = [None] * len(jobs)
+        missing = []
+        for i, (spec, output_format) in enumerate(jobs):
+            spec_json = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+            path = self.get_path(spec_json, output_format) if self.cache_dir else None
+            if path and os.path.exists(path):
+                self.hits += 1
+                with open(path, encoding='utf8') as f:
+                    results[i] = f.read() if output_format == 'svg' else json.load(f)
+            else:
+                self.misses += 1
+                missing.append((i, spec_json, output_format, path))
+
+        def render_one(job):
+            i, spec_json, output_format, path = job
+            return i, FORMATS[output_format][1](spec_json), output_format, path
+
+        if self.workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(min(self.workers, len(missing))) as pool:
+                rendered = list(pool.map(render_one, missing))
+        else:
+            rendered = [render_one(job) for job in missing]
+
+        for i, result, output_format, path in rendered:
+            results[i] = result
+            if path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                fd, part_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+                with os.fdopen(fd, 'w', encoding='utf8') as f:
+                    f.write(result if output_format == 'svg' else json.dumps(result))
+                os.replace(part_path, path)
+
+        return results
+
+    def report(self):
+        return f'vega cache: {self.hits} hits, {self.misses} misses'